@@ -0,0 +1,165 @@
+# Headless batch rendering: fetch -> parse -> style -> layout -> paint for many pages, across a process pool
+import argparse
+import json
+import os
+import sys
+import time
+import tkinter
+from concurrent.futures import ProcessPoolExecutor
+from url import URL
+from browser import DOM_CACHE, load_stylesheets, paint_tree
+from css_parser import style
+from layout_tree import DocumentLayout
+from display_list import compact
+from parallel_layout import start_workers, layout_parallel
+from font_metrics import set_backend
+
+
+def init_worker(font_backend):
+    """Selects the font metrics backend of a worker; the Tk one needs a (hidden) Tk root and a display"""
+    if font_backend == "tk":
+        root = tkinter.Tk()
+        root.withdraw()
+    set_backend(font_backend)
+
+
+def to_url(item):
+    """Accepts both URLs and plain file paths"""
+    if "://" in item or item.startswith("data:") or item.startswith("view-source:"):
+        return URL(item)
+    return URL("file://" + os.path.relpath(item)) # file URLs are resolved relative to the working directory
+
+
+def serialize_command(cmnd):
+    """Turns a display list command into a JSON friendly dict"""
+    record = {
+        "type": type(cmnd).__name__,
+        "rect": [cmnd.rect.left, cmnd.rect.top, cmnd.rect.right, cmnd.rect.bottom],
+    }
+    for attr in ["text", "color", "thickness"]:
+        if hasattr(cmnd, attr):
+            record[attr] = getattr(cmnd, attr)
+    if hasattr(cmnd, "font"):
+        record["font"] = [cmnd.font.cget("size"), cmnd.font.cget("weight"), cmnd.font.cget("slant")]
+    return record
+
+
+def render_page(job):
+    """Renders one page and writes its display list and per-phase timings to `out_dir`.
+    `layout_pool` is None, or (executor, workers) to lay out the page with parallel_layout."""
+    index, item, out_dir, layout_pool = job
+    timings = {}
+    result = {"index": index, "input": item, "timings": timings}
+
+    def phase(name, start):
+        now = time.perf_counter()
+        timings[name] = now - start
+        return now
+
+    try:
+        start = time.perf_counter()
+        url = to_url(item)
+        body = url.request()
+        start = phase("fetch", start)
+
+        nodes = DOM_CACHE.parse(body)
+        start = phase("parse", start)
+
+        style(nodes, load_stylesheets(nodes, url))
+        start = phase("style", start)
+
+        document = DocumentLayout(nodes)
+        if layout_pool is None:
+            document.layout()
+        else:
+            layout_parallel(document, *layout_pool)
+        start = phase("layout", start)
+
+        display_list = []
+        paint_tree(document, display_list)
+        painted = len(display_list)
+        display_list = compact(display_list)
+        start = phase("paint", start)
+
+        page = {
+            "url": str(url),
+            "height": document.height,
+            "timings": timings,
+            "display_list": [serialize_command(cmnd) for cmnd in display_list],
+        }
+        with open(os.path.join(out_dir, "page-{:05d}.json".format(index)), "w") as f:
+            json.dump(page, f)
+        phase("write", start)
+
+        result["painted"] = painted # commands before compaction
+        result["commands"] = len(display_list)
+    except (Exception, SystemExit) as e: # URL.request() exits on unreadable files
+        result["error"] = "{}: {}".format(type(e).__name__, e)
+
+    return result
+
+
+def read_inputs(args):
+    items = list(args.inputs)
+    if args.input_list:
+        with open(args.input_list) as f:
+            for line in f:
+                line = line.strip()
+                if line and not line.startswith("#"):
+                    items.append(line)
+    return items
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Render many pages headlessly and dump their display lists.")
+    parser.add_argument("inputs", nargs="*", help="URLs or HTML file paths")
+    parser.add_argument("-i", "--input-list", help="file with one URL/path per line")
+    parser.add_argument("-o", "--out-dir", default="batch_output", help="where to write per-page results")
+    parser.add_argument("-j", "--jobs", type=int, default=os.cpu_count(), help="number of worker processes")
+    parser.add_argument("--font-backend", choices=["truetype", "tk"], default="truetype", help="how text is measured (tk needs a display)")
+    parser.add_argument("--parallel-layout", type=int, metavar="WORKERS",
+                        help="render pages one at a time, each laid out by this many worker processes (for a few very large pages)")
+    args = parser.parse_args(argv)
+
+    items = read_inputs(args)
+    if not items:
+        parser.error("no pages to render")
+    if args.parallel_layout and args.font_backend == "tk":
+        parser.error("--parallel-layout needs the truetype font backend")
+    os.makedirs(args.out_dir, exist_ok=True)
+
+    start = time.perf_counter()
+    if args.parallel_layout:
+        init_worker(args.font_backend)
+        with start_workers(args.parallel_layout) as executor:
+            layout_pool = (executor, args.parallel_layout)
+            results = [render_page((i, item, args.out_dir, layout_pool)) for i, item in enumerate(items)]
+    else:
+        jobs = [(i, item, args.out_dir, None) for i, item in enumerate(items)]
+        chunksize = max(1, len(jobs) // (4 * args.jobs)) # big enough to amortize IPC, small enough to balance load
+        with ProcessPoolExecutor(max_workers=args.jobs, initializer=init_worker, initargs=(args.font_backend,)) as pool:
+            results = list(pool.map(render_page, jobs, chunksize=chunksize))
+    elapsed = time.perf_counter() - start
+
+    failed = [result for result in results if "error" in result]
+    summary = {
+        "pages": len(results),
+        "failed": len(failed),
+        "jobs": args.jobs,
+        "parallel_layout": args.parallel_layout,
+        "elapsed": elapsed,
+        "pages_per_second": len(results) / elapsed if elapsed else None,
+        "results": results,
+    }
+    with open(os.path.join(args.out_dir, "summary.json"), "w") as f:
+        json.dump(summary, f, indent=2)
+
+    workers = f"{args.parallel_layout} layout workers" if args.parallel_layout else f"{args.jobs} workers"
+    print(f"Rendered {len(results) - len(failed)}/{len(results)} pages in {elapsed:.2f}s with {workers}")
+    for result in failed:
+        print(f" {result['input']}: {result['error']}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
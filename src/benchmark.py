@@ -0,0 +1,972 @@
+# Micro benchmarks for the rendering pipeline, runs headless with the TrueType font backend
+import argparse
+import heapq
+import itertools
+import os
+import random
+import sys
+import time
+import tracemalloc
+from url import URL
+from parser import HTMLParser, Text, Element
+from css_parser import style, restyle, CSSParser, RuleMap, AncestorFilter, StyleSharingCache, TagSelector, DescendantSelector
+from css_parser import inline_style, INLINE_STYLES
+from stylesheet_cache import compile_rules
+from utils import cascade_priority
+from traversal import preorder, find_last
+import layout_tree
+from layout_tree import DocumentLayout, BlockLayout
+from browser import load_stylesheets, paint_tree, Chrome, Tab
+from parallel_layout import start_workers, layout_parallel
+from batch import serialize_command
+from display_list import DisplayList, compact
+from canvas_layer import RetainedLayer
+from frame_scheduler import FrameScheduler
+from hit_test import HitTestIndex
+import font_metrics
+from font_registry import FONT_REGISTRY
+from constants import WIDTH, HEIGHT, VSTEP, SCROLL_STEP, LAZY_LAYOUT_MARGIN
+
+WORDS = ("the a of to and in is it that for on was with as be by this are from at or an which "
+         "browser layout style parser render token tree node paint font width height line block "
+         "inline cascade selector element attribute document window scroll canvas measure").split()
+
+
+def synthetic_page(paragraphs, words_per_paragraph=80, seed=0):
+    """A long, text heavy page with a realistic amount of repeated words"""
+    rng = random.Random(seed)
+    body = []
+    for i in range(paragraphs):
+        words = [rng.choice(WORDS) for _ in range(words_per_paragraph)]
+        words[rng.randrange(len(words))] = "<b>{}</b>".format(rng.choice(WORDS))
+        words[rng.randrange(len(words))] = "<i>{}</i>".format(rng.choice(WORDS))
+        if i % 10 == 0:
+            body.append("<h2>Section {}</h2>".format(i // 10))
+        body.append("<p>{}</p>".format(" ".join(words)))
+    return "<html><body>{}</body></html>".format("\n".join(body))
+
+
+def load_pages(paths, paragraphs):
+    """(name, url, body) for each requested file, or the bundled pages plus a synthetic long one"""
+    pages = []
+    for path in paths or ["test.html", "resume.html"]:
+        url = URL("file://" + path)
+        pages.append((path, url, url.request()))
+    if not paths:
+        pages.append(("synthetic-{}p".format(paragraphs), URL("file://synthetic.html"), synthetic_page(paragraphs)))
+    return pages
+
+
+TAGS = ("div span p a b i em strong ul ol li h1 h2 h3 h4 table tr td th pre code "
+        "section article nav header footer aside main small big sup label form input button").split()
+PROPERTIES = ["color", "background-color", "font-size", "font-weight", "font-style", "margin", "padding"]
+
+
+def synthetic_stylesheet(rules, seed=0):
+    """A large site-wide style sheet: mostly tag rules, some descendant ones"""
+    rng = random.Random(seed)
+    out = []
+    for _ in range(rules):
+        selector = " ".join(rng.choice(TAGS) for _ in range(rng.choice([1, 1, 2, 3])))
+        body = "; ".join("{}: {}".format(prop, rng.choice(["red", "blue", "12px", "bold", "normal", "1em"]))
+                         for prop in rng.sample(PROPERTIES, 2))
+        out.append("{} {{ {}; }}".format(selector, body))
+    return "\n".join(out)
+
+
+def styled_tree(url, body):
+    nodes = HTMLParser(body).parse()
+    style(nodes, load_stylesheets(nodes, url))
+    return nodes
+
+
+def render(nodes):
+    document = DocumentLayout(nodes)
+    document.layout()
+    display_list = []
+    paint_tree(document, display_list)
+    return document, display_list
+
+
+# font backend instrumentation
+
+class CountingFont:
+    """Wraps a backend font and counts the calls that reach it (Tcl round trips with the Tk backend)"""
+    def __init__(self, font, calls):
+        self.font = font
+        self.calls = calls
+
+    def measure(self, text):
+        self.calls["measure"] += 1
+        return self.font.measure(text)
+
+    def metrics(self, *options):
+        self.calls["metrics"] += 1
+        return self.font.metrics(*options)
+
+    def cget(self, option):
+        return self.font.cget(option)
+
+    def __str__(self):
+        return str(self.font)
+
+
+class CountingBackend:
+    def __init__(self, backend):
+        self.backend = backend
+        self.name = backend.name + "-counting"
+        self.calls = {"measure": 0, "metrics": 0}
+
+    def create_font(self, size, weight, style):
+        return CountingFont(self.backend.create_font(size, weight, style), self.calls)
+
+    def reset(self):
+        self.calls["measure"] = self.calls["metrics"] = 0
+
+    def total(self):
+        return self.calls["measure"] + self.calls["metrics"]
+
+
+def bench_measure(args):
+    """Font backend calls per layout, with and without the measurement cache"""
+    backend = font_metrics.set_backend(CountingBackend(font_metrics.get_backend()))
+    cache = font_metrics.MEASURE_CACHE
+
+    print("{:<20} {:>14} {:>14} {:>14} {:>9} {:>10} {:>10}".format(
+        "page", "calls uncached", "calls cold", "calls warm", "hit rate", "ms before", "ms after"))
+    for name, url, body in load_pages(args.files, args.paragraphs):
+        nodes = styled_tree(url, body)
+        row = []
+        for enabled, clear in [(False, True), (True, True), (True, False)]:
+            cache.enabled = enabled
+            if clear:
+                cache.clear()
+            backend.reset()
+            start = time.perf_counter()
+            render(nodes)
+            row.append((backend.total(), (time.perf_counter() - start) * 1000))
+        print("{:<20} {:>14} {:>14} {:>14} {:>8.1%} {:>10.1f} {:>10.1f}".format(
+            name, row[0][0], row[1][0], row[2][0], cache.hit_rate(), row[0][1], row[2][1]))
+    cache.enabled = True
+
+
+def bench_fonts(args):
+    """Fonts created and kept alive by the font registry while rendering"""
+    for name, url, body in load_pages(args.files, args.paragraphs):
+        start = time.perf_counter()
+        render(styled_tree(url, body))
+        print("{:<20} {:>8.1f} ms".format(name, (time.perf_counter() - start) * 1000))
+    report = FONT_REGISTRY.report()
+    print("fonts created {created}, cached {cached}, live {live}, evictions {evictions}, "
+          "creation {creation_time:.4f}s total / {avg_creation_time:.6f}s avg".format(**report))
+
+
+class LinearRules(RuleMap):
+    """The old cascade: every rule is a candidate for every node"""
+    def candidates(self, node):
+        return [(index, selector, body) for index, (selector, body) in enumerate(self.rules)]
+
+
+def bench_cascade(args):
+    """style() over every node with all rules vs. rules bucketed by rightmost selector (without style
+    sharing, which would run the cascade only once per distinct style)"""
+    sheet = CSSParser(synthetic_stylesheet(args.rules)).parse()
+    print("{:<20} {:>7} {:>12} {:>12} {:>11} {:>11} {:>9}".format(
+        "page", "nodes", "ms linear", "ms buckets", "cand/node", "match/node", "speedup"))
+    for name, url, body in load_pages(args.files, args.paragraphs):
+        nodes = HTMLParser(body).parse()
+        rules = sorted(load_stylesheets(nodes, url).rules + sheet, key=cascade_priority)
+        timings, reports, styles = [], [], []
+        for rule_map in [LinearRules(rules), RuleMap(rules)]:
+            start = time.perf_counter()
+            style(nodes, rule_map, sharing=NoStyleSharing())
+            timings.append((time.perf_counter() - start) * 1000)
+            reports.append(rule_map.report())
+            styles.append([dict(node.style) for node in preorder(nodes)])
+        assert styles[0] == styles[1], "bucketed cascade changed computed styles"
+        print("{:<20} {:>7} {:>12.1f} {:>12.1f} {:>11.1f} {:>11.1f} {:>8.1f}x".format(
+            name, reports[1]["nodes"], timings[0], timings[1], reports[1]["candidates_per_node"],
+            reports[1]["matches_per_node"], timings[0] / timings[1]))
+
+
+def nested_page(depth, width, seed=0):
+    """Deeply nested generated markup: chains of `depth` divs/sections, `width` of them side by side"""
+    rng = random.Random(seed)
+    chains = []
+    for _ in range(width):
+        tags = [rng.choice(["div", "div", "section", "span"]) for _ in range(depth)]
+        chain = "".join("<{}>".format(tag) for tag in tags) + "<p>leaf <b>text</b></p>"
+        chain += "".join("</{}>".format(tag) for tag in reversed(tags))
+        chains.append(chain)
+    return "<html><body>{}</body></html>".format("".join(chains))
+
+
+class NoAncestorFilter(AncestorFilter):
+    """Always answers "maybe", i.e. every descendant selector walks to the root"""
+    def push(self, node):
+        pass
+
+    def pop(self, node):
+        pass
+
+    def might_contain(self, key):
+        return True
+
+
+def bench_bloom(args):
+    """Descendant selector matching on deep trees, with and without the ancestor Bloom filter"""
+    # descendant rules whose ancestor mostly isn't there, plus a few that are
+    ancestors = [tag for tag in TAGS if tag not in ("div", "section", "span")]
+    sheet = "\n".join("{} {} {{ color: red; }}".format(ancestor, leaf)
+                       for ancestor in ancestors for leaf in ["p", "b", "div", "span"])
+    sheet += "\nsection p { color: blue; } div b { font-weight: bold; }"
+    rules = sorted(CSSParser(sheet).parse(), key=cascade_priority)
+
+    print("{:>7} {:>7} {:>12} {:>12} {:>9}".format("depth", "nodes", "ms walk", "ms filter", "speedup"))
+    for depth in [10, 50, 100, 200]:
+        nodes = HTMLParser(nested_page(depth, args.width)).parse()
+        timings, styles = [], []
+        for ancestor_filter in [NoAncestorFilter(), AncestorFilter()]:
+            start = time.perf_counter()
+            style(nodes, RuleMap(rules), ancestor_filter)
+            timings.append((time.perf_counter() - start) * 1000)
+            styles.append([dict(node.style) for node in preorder(nodes)])
+        assert styles[0] == styles[1], "ancestor filter changed computed styles"
+        print("{:>7} {:>7} {:>12.1f} {:>12.1f} {:>8.1f}x".format(
+            depth, len(styles[0]), timings[0], timings[1], timings[0] / timings[1]))
+
+
+def bench_deep(args):
+    """Every pass over very deep documents, far below Python's recursion limit"""
+    print("{:>7} {:>8} {:>9} {:>9} {:>9} {:>9} {:>9}".format("depth", "nodes", "ms parse", "ms style", "ms layout", "ms paint", "ms hit"))
+    rules = load_stylesheets(HTMLParser("").parse(), URL("file://deep.html"))
+    for depth in [100, 1000, 10000, 50000]:
+        start = time.perf_counter()
+        chain = "<div>" * depth + "<p>leaf <b>text</b></p>" + "</div>" * depth # all blocks, as deep in layout as in the DOM
+        nodes = HTMLParser("<html><body>{}</body></html>".format(chain * 2)).parse()
+        timings = [time.perf_counter() - start]
+
+        start = time.perf_counter()
+        style(nodes, rules)
+        timings.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        document = DocumentLayout(nodes)
+        document.layout()
+        timings.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        display_list = []
+        paint_tree(document, display_list)
+        timings.append(time.perf_counter() - start)
+
+        start = time.perf_counter()
+        find_last(document, lambda obj: obj.x <= 20 < obj.x + obj.width and obj.y <= 20 < obj.y + obj.height)
+        timings.append(time.perf_counter() - start)
+
+        print("{:>7} {:>8} {}".format(depth, sum(1 for _ in preorder(nodes)), " ".join("{:>9.1f}".format(t * 1000) for t in timings)))
+
+
+def list_page(lists, items, seed=0):
+    """A list heavy page: many <ul>s of short <li> items, some with links and emphasis"""
+    rng = random.Random(seed)
+    out = []
+    for i in range(lists):
+        out.append("<h3>List {}</h3><ul>".format(i))
+        for j in range(items):
+            word = rng.choice(WORDS)
+            if j % 5 == 0:
+                word = '<a href="/{0}">{0}</a>'.format(word)
+            elif j % 7 == 0:
+                word = "<b>{}</b>".format(word)
+            out.append("<li>{} {}</li>".format(word, rng.choice(WORDS)))
+        out.append("</ul>")
+    return "<html><body>{}</body></html>".format("".join(out))
+
+
+class NoStyleSharing(StyleSharingCache):
+    """The old behaviour: a fresh style for every node, Text nodes included"""
+    def lookup(self, node):
+        return None
+
+
+def bench_sharing(args):
+    """Time and memory of style() with and without computed style sharing, on list heavy pages"""
+    url = URL("file://list.html")
+    print("{:>7} {:>7} {:>10} {:>10} {:>10} {:>10} {:>8} {:>8}".format(
+        "lists", "nodes", "ms fresh", "ms shared", "KB fresh", "KB shared", "unique", "shared"))
+    for lists in [10, 50, 200]:
+        body = list_page(lists, 50)
+        timings, memory, styles = [], [], []
+        for sharing in [NoStyleSharing(), StyleSharingCache()]:
+            nodes = HTMLParser(body).parse()
+            rules = RuleMap(load_stylesheets(nodes, url).rules)
+            tracemalloc.start()
+            start = time.perf_counter()
+            style(nodes, rules, None, sharing)
+            timings.append((time.perf_counter() - start) * 1000)
+            memory.append(tracemalloc.get_traced_memory()[0] / 1024)
+            tracemalloc.stop()
+            styles.append([dict(node.style) for node in preorder(nodes) if not isinstance(node, Text)])
+        assert styles[0] == styles[1], "style sharing changed computed styles"
+        report = sharing.report()
+        print("{:>7} {:>7} {:>10.1f} {:>10.1f} {:>10.0f} {:>10.0f} {:>8} {:>7.0%}".format(
+            lists, report["nodes"], timings[0], timings[1], memory[0], memory[1],
+            report["unique_styles"], report["sharing_ratio"]))
+
+
+def bench_restyle(args):
+    """Nodes restyled and time per inline style change, incremental vs. a full style() pass"""
+    url = URL("file://list.html")
+    nodes = HTMLParser(list_page(200, 50)).parse()
+    rules = RuleMap(load_stylesheets(nodes, url).rules)
+    style(nodes, rules)
+    elements = [node for node in preorder(nodes) if isinstance(node, Element)]
+    rng = random.Random(0)
+
+    updates, visited, restyled, incremental = 20, 0, 0, 0.0
+    for _ in range(updates):
+        rng.choice(elements).set_attribute("style", rng.choice(["color: red;", "font-size: 150%;", "font-weight: bold;"]))
+        start = time.perf_counter()
+        stats = restyle(nodes, rules)
+        incremental += time.perf_counter() - start
+        visited += stats["visited"]
+        restyled += stats["restyled"]
+
+    start = time.perf_counter()
+    style(nodes, rules)
+    full = time.perf_counter() - start
+    print("nodes {}, per update: visited {:.1f}, restyled {:.1f}, {:.3f} ms (full style() {:.1f} ms)".format(
+        len(elements), visited / updates, restyled / updates, incremental / updates * 1000, full * 1000))
+
+
+def bench_relayout(args):
+    """Layout objects touched and time per style/text change, incremental vs. a fresh DocumentLayout"""
+    url = URL("file://list.html")
+    nodes = HTMLParser(list_page(200, 50)).parse()
+    rules = RuleMap(load_stylesheets(nodes, url).rules)
+    style(nodes, rules)
+    document = DocumentLayout(nodes)
+    document.layout()
+    elements = [node for node in preorder(nodes) if isinstance(node, Element)]
+    texts = [node for node in preorder(nodes) if isinstance(node, Text)]
+    rng = random.Random(0)
+
+    updates, incremental = 20, 0.0
+    touched = {"laid_out": 0, "shifted": 0, "reused": 0}
+    for i in range(updates):
+        if i % 2:
+            text = rng.choice(texts)
+            text.set_text(text.text + " and a few more words")
+        else:
+            rng.choice(elements).set_attribute("style", rng.choice(["font-size: 150%;", "font-weight: bold;"]))
+        restyle(nodes, rules)
+        start = time.perf_counter()
+        stats = document.layout()
+        incremental += time.perf_counter() - start
+        for key in touched:
+            touched[key] += stats[key]
+
+    start = time.perf_counter()
+    fresh = DocumentLayout(nodes)
+    fresh.layout()
+    full = time.perf_counter() - start
+    assert fresh.height == document.height, "incremental layout diverged from a fresh one"
+    print("layout objects {}, per update: laid out {:.1f}, shifted {:.1f}, blocks reused {:.1f}, {:.2f} ms (full layout {:.1f} ms)".format(
+        sum(1 for _ in preorder(fresh)), touched["laid_out"] / updates, touched["shifted"] / updates,
+        touched["reused"] / updates, incremental / updates * 1000, full * 1000))
+
+
+def bench_memory(args):
+    """Layout objects, layout time and peak memory of a layout, e.g. with --paragraphs 2000 for a ~1 MB page"""
+    print("{:<20} {:>8} {:>9} {:>10} {:>11} {:>10}".format("page", "KB", "objects", "ms layout", "peak MB", "commands"))
+    for name, url, body in load_pages(args.files, args.paragraphs):
+        nodes = styled_tree(url, body)
+        render(nodes) # warm up the font and measurement caches
+
+        start = time.perf_counter()
+        document = DocumentLayout(nodes)
+        document.layout()
+        elapsed = time.perf_counter() - start
+
+        tracemalloc.start()
+        document = DocumentLayout(nodes)
+        document.layout()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+
+        display_list = []
+        paint_tree(document, display_list)
+        print("{:<20} {:>8} {:>9} {:>10.1f} {:>11.1f} {:>10}".format(
+            name, len(body) // 1000, sum(1 for _ in preorder(document)), elapsed * 1000, peak / 1e6, len(display_list)))
+
+
+def bench_resize(args):
+    """Relayout at a new window width: width-only reflow of a laid out document vs. a fresh layout"""
+    print("{:<20} {:>7} {:>13} {:>13} {:>9}".format("page", "width", "ms fresh", "ms reflow", "speedup"))
+    for name, url, body in load_pages(args.files, args.paragraphs):
+        nodes = styled_tree(url, body)
+        document = DocumentLayout(nodes)
+        document.layout()
+        for width in [900, 600, 1500, WIDTH]:
+            start = time.perf_counter()
+            fresh = DocumentLayout(nodes, width)
+            fresh.layout()
+            full = time.perf_counter() - start
+
+            start = time.perf_counter()
+            document.resize(width)
+            document.layout()
+            reflow = time.perf_counter() - start
+            assert fresh.height == document.height, "reflow diverged from a fresh layout"
+            print("{:<20} {:>7} {:>13.1f} {:>13.1f} {:>8.1f}x".format(name, width, full * 1000, reflow * 1000, full / reflow))
+
+
+def bench_linebreak(args):
+    """Line breaking of every inline block at a few widths: word by word vs. a line at a time from prefix sums"""
+    min_run = layout_tree.LINE_BREAK_MIN_RUN
+    modes = [("word", float("inf")), ("line", min_run)]
+    print("{:<20} {:>7} {:>8}".format("page", "blocks", "lines") + "".join("{:>12}".format("ms " + mode) for mode, _ in modes))
+    for name, url, body in load_pages(args.files, args.paragraphs):
+        document, _ = render(styled_tree(url, body))
+        blocks = [block for block in preorder(document) if isinstance(block, BlockLayout) and block.inline is not None]
+        for block in blocks:
+            block.inline.one_line() # prefix sums are computed once per content, not per width
+
+        results, times = None, []
+        for _, layout_tree.LINE_BREAK_MIN_RUN in modes:
+            lines = []
+            start = time.perf_counter()
+            for width in [900, 600, 300]:
+                for block in blocks:
+                    block.width, block.children = width, []
+                    block.flow(block.inline)
+                    lines.append([line.words for line in block.children])
+            times.append(time.perf_counter() - start)
+            assert results is None or lines == results, "line breaks differ between modes"
+            results = lines
+        layout_tree.LINE_BREAK_MIN_RUN = min_run
+        print("{:<20} {:>7} {:>8}".format(name, len(blocks), sum(len(block) for block in results))
+              + "".join("{:>12.1f}".format(elapsed * 1000) for elapsed in times))
+
+
+def bench_lazy(args):
+    """Time to first paint (layout and paint, the page is already styled) of a full layout vs. a lazy
+    one stopping below the first screen, on pages of growing length"""
+    until = HEIGHT + 2 * LAZY_LAYOUT_MARGIN # what Tab.render() asks for at the top of a page
+    print("{:<20} {:>8} {:>10} {:>10} {:>9} {:>10} {:>12}".format(
+        "page", "KB", "ms full", "ms lazy", "speedup", "estimated", "height error"))
+    for paragraphs in [args.paragraphs // 4, args.paragraphs, args.paragraphs * 4]:
+        body = synthetic_page(paragraphs)
+        nodes = styled_tree(URL("file://synthetic.html"), body)
+        render(nodes) # warm up the font and measurement caches
+
+        start = time.perf_counter()
+        full, _ = render(nodes)
+        full_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        document = DocumentLayout(nodes)
+        stats = document.layout(until)
+        paint_tree(document, [])
+        lazy_time = time.perf_counter() - start
+        print("{:<20} {:>8} {:>10.1f} {:>10.1f} {:>8.1f}x {:>10} {:>11.1f}%".format(
+            "synthetic-{}p".format(paragraphs), len(body) // 1000, full_time * 1000, lazy_time * 1000,
+            full_time / lazy_time, stats["estimated"], 100 * (document.height - full.height) / full.height))
+
+
+def bench_parallel(args):
+    """First layout of large documents, in this process vs. with subtrees in 1, 2, 4... worker processes
+    (the pools are warmed up first, like in a long running batch)"""
+    counts = sorted({1, 2, 4, os.cpu_count() or 1})
+    print("{} CPUs".format(os.cpu_count()))
+    print("{:<20} {:>8} {:>10}".format("page", "KB", "ms serial") + "".join("{:>12}".format("ms {} proc".format(n)) for n in counts))
+    pools = {workers: start_workers(workers) for workers in counts}
+    for paragraphs in [args.paragraphs, args.paragraphs * 4]:
+        body = synthetic_page(paragraphs)
+        nodes = styled_tree(URL("file://synthetic.html"), body)
+        serial, display_list = render(nodes) # also warms up this process's caches
+        expected = [serialize_command(cmnd) for cmnd in display_list]
+
+        start = time.perf_counter()
+        DocumentLayout(nodes).layout()
+        times = [time.perf_counter() - start]
+        for workers in counts:
+            layout_parallel(DocumentLayout(nodes), pools[workers], workers) # warm up the workers' caches
+            start = time.perf_counter()
+            document = DocumentLayout(nodes)
+            layout_parallel(document, pools[workers], workers)
+            times.append(time.perf_counter() - start)
+            display_list = []
+            paint_tree(document, display_list)
+            assert [serialize_command(cmnd) for cmnd in display_list] == expected, "parallel layout differs"
+        print("{:<20} {:>8}".format("synthetic-{}p".format(paragraphs), len(body) // 1000)
+              + "".join("{:>10.1f}  ".format(elapsed * 1000) if i else "{:>10.1f}".format(elapsed * 1000) for i, elapsed in enumerate(times)))
+    for pool in pools.values():
+        pool.shutdown()
+
+
+def bench_cull(args):
+    """Finding the commands to draw for a frame: testing every command vs. the display list's index"""
+    viewport = HEIGHT
+    print("{:<20} {:>9} {:>9} {:>12} {:>12} {:>9}".format("page", "commands", "visible", "us scan", "us index", "speedup"))
+    for name, url, body in load_pages(args.files, args.paragraphs):
+        _, commands = render(styled_tree(url, body))
+        display_list = DisplayList(commands)
+        bottom = max([cmnd.rect.bottom for cmnd in commands] + [viewport])
+        scrolls = range(-VSTEP, int(bottom), max(1, int(bottom) // 200))
+
+        start = time.perf_counter()
+        scanned = [[cmnd for cmnd in commands if not (cmnd.rect.top > scroll + viewport or cmnd.rect.bottom < scroll)]
+                   for scroll in scrolls]
+        scan = (time.perf_counter() - start) / len(scrolls)
+
+        start = time.perf_counter()
+        indexed = [display_list.visible(scroll, scroll + viewport) for scroll in scrolls]
+        index = (time.perf_counter() - start) / len(scrolls)
+        assert scanned == indexed, "the index found other commands"
+        print("{:<20} {:>9} {:>9.0f} {:>12.1f} {:>12.1f} {:>8.1f}x".format(
+            name, len(commands), sum(map(len, indexed)) / len(scrolls), scan * 1e6, index * 1e6, scan / index))
+
+
+def bench_compact(args):
+    """Commands (so canvas items) per page and per frame before and after display list compaction, and its cost"""
+    print("{:<20} {:>9} {:>9} {:>12} {:>12} {:>9} {:>11}".format(
+        "page", "painted", "commands", "items/frame", "compacted", "ms paint", "ms compact"))
+    for name, url, body in load_pages(args.files, args.paragraphs):
+        document, _ = render(styled_tree(url, body))
+        start = time.perf_counter()
+        painted = []
+        paint_tree(document, painted)
+        paint = time.perf_counter() - start
+
+        start = time.perf_counter()
+        commands = compact(painted)
+        elapsed = time.perf_counter() - start
+
+        def words(cmnds):
+            return " ".join([cmnd.text for cmnd in cmnds if hasattr(cmnd, "text")]).split()
+        assert words(commands) == words(painted), "compaction lost words"
+
+        bottom = int(max([cmnd.rect.bottom for cmnd in painted] + [HEIGHT]))
+        scrolls = range(-VSTEP, bottom, HEIGHT // 2)
+        per_frame = [sum([len(DisplayList(cmnds).visible(scroll, scroll + HEIGHT)) for scroll in scrolls]) / len(scrolls)
+                     for cmnds in [painted, commands]]
+        print("{:<20} {:>9} {:>9} {:>12.0f} {:>12.0f} {:>9.1f} {:>11.1f}".format(
+            name, len(painted), len(commands), per_frame[0], per_frame[1], paint * 1000, elapsed * 1000))
+
+
+def bench_hittest(args):
+    """Clicks at random points: walking the whole layout tree vs. the hit-test index (cold, i.e. the first
+    clicks after a layout, and warm)"""
+    rng = random.Random(0)
+    print("{:<20} {:>9} {:>10} {:>10} {:>10} {:>9}".format("page", "objects", "us walk", "us cold", "us warm", "speedup"))
+    for name, url, body in load_pages(args.files, args.paragraphs):
+        document, _ = render(styled_tree(url, body))
+        points = [(rng.randrange(-10, WIDTH + 10), rng.randrange(-10, document.height + 10)) for _ in range(200)]
+
+        start = time.perf_counter()
+        walked = [find_last(document, lambda obj: obj.x <= x < obj.x + obj.width and obj.y <= y < obj.y + obj.height)
+                  for x, y in points]
+        walk = (time.perf_counter() - start) / len(points)
+
+        times = []
+        index = HitTestIndex(document)
+        for _ in range(2):
+            start = time.perf_counter()
+            indexed = [index.hit(x, y) for x, y in points]
+            times.append((time.perf_counter() - start) / len(points))
+            assert indexed == walked, "the index found other objects"
+        print("{:<20} {:>9} {:>10.1f} {:>10.1f} {:>10.1f} {:>8.0f}x".format(
+            name, sum(1 for _ in preorder(document)), walk * 1e6, times[0] * 1e6, times[1] * 1e6, walk / times[1]))
+
+
+class RecordingCanvas:
+    """Stands in for a Tk canvas: keeps the items (kind, coordinates, options, tags) in stacking order
+    and counts the calls, each of which is a Tcl round trip with a real canvas"""
+    def __init__(self):
+        self.items = {} # id -> [kind, coordinates, options, tags]
+        self.order = [] # ids, bottom to top
+        self.next_id = 1
+        self.calls = 0
+
+    def create(self, kind, coords, options):
+        self.calls += 1
+        tags = set(options.pop("tags", ()))
+        item = self.next_id
+        self.next_id += 1
+        self.items[item] = [kind, list(coords), options, tags]
+        self.order.append(item)
+        return item
+
+    def create_text(self, *coords, **options):
+        return self.create("text", coords, options)
+
+    def create_rectangle(self, *coords, **options):
+        return self.create("rectangle", coords, options)
+
+    def create_line(self, *coords, **options):
+        return self.create("line", coords, options)
+
+    def find(self, tag):
+        """Ids of the items with this tag (or this id), bottom to top"""
+        if isinstance(tag, int):
+            return [tag] if tag in self.items else []
+        return [item for item in self.order if tag == "all" or tag in self.items[item][3]]
+
+    def move(self, tag, dx, dy):
+        self.calls += 1
+        for item in self.find(tag):
+            coords = self.items[item][1]
+            for i in range(len(coords)):
+                coords[i] += dy if i % 2 else dx
+
+    def delete(self, *tags):
+        self.calls += 1
+        gone = {item for tag in tags for item in self.find(tag)}
+        for item in gone:
+            del self.items[item]
+        self.order = [item for item in self.order if item not in gone]
+
+    def dtag(self, tag, remove):
+        self.calls += 1
+        for item in self.find(tag):
+            self.items[item][3].discard(remove)
+
+    def tag_lower(self, tag, below):
+        self.calls += 1
+        moved = self.find(tag)
+        rest = [item for item in self.order if item not in moved]
+        at = rest.index(self.find(below)[0])
+        self.order = rest[:at] + moved + rest[at:]
+
+    def picture(self, items=None):
+        """What the items (all of them by default) look like, bottom to top"""
+        return [(kind, coords, sorted((key, str(value)) for key, value in options.items()))
+                for kind, coords, options, _ in (self.items[item] for item in self.order if items is None or item in items)]
+
+
+def bench_retained(args):
+    """Canvas calls per frame while scrolling down and back up: drawing every frame from scratch vs.
+    keeping the items of the page on the canvas and moving them"""
+    offset, height = 40, HEIGHT - 40 # below the browser chrome
+    print("{:<20} {:>9} {:>8} {:>14} {:>14} {:>14}".format(
+        "page", "commands", "frames", "calls redraw", "calls retained", "items created"))
+    for name, url, body in load_pages(args.files, args.paragraphs):
+        _, commands = render(styled_tree(url, body))
+        display_list = DisplayList(commands)
+        bottom = int(max([cmnd.rect.bottom for cmnd in commands] + [height]))
+        down = list(range(-VSTEP, min(bottom, 100 * SCROLL_STEP), SCROLL_STEP))
+        scrolls = down + down[::-1] + [down[-1] // 2, 0] # and a couple of jumps
+
+        redraw, retained = RecordingCanvas(), RecordingCanvas()
+        layer = RetainedLayer(retained, "content")
+        for scroll in scrolls:
+            redraw.delete("all")
+            for cmnd in display_list.visible(scroll, scroll + height):
+                cmnd.execute(scroll - offset, redraw)
+            layer.draw(display_list, scroll, height, offset)
+            shown = {layer.items[i] for i in display_list.visible_indices(scroll, scroll + height)}
+            assert retained.picture(shown) == redraw.picture(), "the retained items look different"
+        print("{:<20} {:>9} {:>8} {:>14.1f} {:>14.1f} {:>14.1f}".format(
+            name, len(commands), len(scrolls), redraw.calls / len(scrolls), retained.calls / len(scrolls),
+            layer.stats["created"] / len(scrolls)))
+
+
+class ChromeHost:
+    """The parts of Browser the chrome reads: the window width and the tabs, here a single one"""
+    def __init__(self, url):
+        self.width = WIDTH
+        self.url = url
+        self.tabs = [self]
+        self.active_tab = self
+
+
+def bench_typing(args):
+    """Canvas calls and time per key typed into the address bar, on pages of growing length: a full frame
+    (all of the chrome, then the page) vs. painting only the damaged parts of the chrome"""
+    typed = "https://browser.engineering/layout.html" + "\b" * 10
+    print("{:<20} {:>9} {:>12} {:>13} {:>10} {:>11}".format(
+        "page", "commands", "calls frame", "calls damage", "us frame", "us damage"))
+    for paragraphs in [args.paragraphs // 4, args.paragraphs, args.paragraphs * 4]:
+        url = URL("file://synthetic.html")
+        _, commands = render(styled_tree(url, synthetic_page(paragraphs)))
+        display_list = DisplayList(commands)
+        results = []
+        for full in [True, False]:
+            canvas = RecordingCanvas()
+            chrome = Chrome(ChromeHost(url))
+            layer = RetainedLayer(canvas, "content", below="chrome")
+
+            def frame():
+                chrome.draw(canvas)
+                layer.draw(display_list, 0, HEIGHT - chrome.bottom, chrome.bottom)
+
+            frame()
+            chrome.click(chrome.address_rect.left + 1, chrome.address_rect.top + 1)
+            frame()
+            canvas.calls = 0
+            start = time.perf_counter()
+            for key in typed:
+                if key == "\b":
+                    chrome.backspace()
+                else:
+                    chrome.keypress(key)
+                if full:
+                    chrome.invalidate()
+                    frame()
+                else:
+                    chrome.draw(canvas) # what Browser.handle_key() does
+            elapsed = time.perf_counter() - start
+            results.append((canvas.calls / len(typed), elapsed / len(typed), canvas.picture()))
+        assert results[0][2] == results[1][2], "the damaged chrome looks different"
+        print("{:<20} {:>9} {:>12.1f} {:>13.1f} {:>10.1f} {:>11.1f}".format(
+            "synthetic-{}p".format(paragraphs), len(commands), results[0][0], results[1][0],
+            results[0][1] * 1e6, results[1][1] * 1e6))
+
+
+class EventLoop:
+    """Stands in for Tk's event loop: input events at given times, after() timers, and after_idle()
+    callbacks, which only run once no event or timer is due"""
+    def __init__(self):
+        self.timers = [] # heap of (time, sequence, callback)
+        self.sequence = 0
+        self.idle = []
+
+    def after(self, ms, callback):
+        heapq.heappush(self.timers, (time.perf_counter() + ms / 1000, self.sequence, callback))
+        self.sequence += 1
+
+    def after_idle(self, callback):
+        self.idle.append(callback)
+
+    def run(self, events, handle):
+        """Calls handle(i) for each of the (increasing) event times once it has come, until nothing is left to do"""
+        i = 0
+        while i < len(events) or self.timers or self.idle:
+            now = time.perf_counter()
+            if i < len(events) and events[i] <= now:
+                handle(i)
+                i += 1
+            elif self.timers and self.timers[0][0] <= now:
+                heapq.heappop(self.timers)[2]()
+            elif self.idle:
+                idle, self.idle = self.idle, []
+                for callback in idle:
+                    callback()
+            else:
+                wake = min(([events[i]] if i < len(events) else []) + ([self.timers[0][0]] if self.timers else []))
+                time.sleep(max(0, wake - now))
+
+
+def bench_frames(args):
+    """Scrolling down a long page with input events coming faster and faster (key repeat, touchpad):
+    a synchronous draw per event vs. the frame scheduler coalescing events into frames. Lag is the
+    time from an event to the end of the frame showing it."""
+    offset = 40 # below the browser chrome
+    body = synthetic_page(args.paragraphs * 4)
+    print("{:<10} {:>10} {:>7} {:>7} {:>10} {:>10} {:>10} {:>10} {:>8}".format(
+        "mode", "ms between", "events", "frames", "coalesced", "ms/frame", "ms lag", "ms lag max", "dropped"))
+    for spacing, mode in itertools.product([0.016, 0.008, 0.004, 0.002], ["sync", "scheduled"]):
+        tab = Tab(HEIGHT - offset)
+        tab.load(URL("data:text/html," + body))
+        layer = RetainedLayer(RecordingCanvas(), "content")
+        loop = EventLoop()
+        start = time.perf_counter()
+        events = [start + spacing * i for i in range(150)]
+        lags, waiting, durations = [], [], []
+
+        def frame():
+            begin = time.perf_counter()
+            tab.resize(tab.width, tab.tab_height) # what Browser.draw() does
+            tab.draw(layer, offset)
+            shown = time.perf_counter()
+            durations.append(shown - begin)
+            lags.extend([shown - events[i] for i in waiting])
+            waiting.clear()
+
+        scheduler = FrameScheduler(loop, frame)
+
+        def handle(i):
+            tab.scrolldown()
+            waiting.append(i)
+            if mode == "sync":
+                frame() # right away, like Browser.handle_down() used to
+            else:
+                scheduler.request()
+
+        loop.run(events, handle)
+        print("{:<10} {:>10} {:>7} {:>7} {:>10} {:>10.1f} {:>10.1f} {:>10.1f} {:>8}".format(
+            mode, spacing * 1000, len(events), len(durations), scheduler.stats["coalesced"], sum(durations) / len(durations) * 1000,
+            sum(lags) / len(lags) * 1000, max(lags) * 1000, scheduler.stats["dropped"] if mode == "scheduled" else "-"))
+
+
+class CharCSSParser:
+    """The old CSS parser, one character (and one exception per malformed token) at a time"""
+    def __init__(self, s):
+        self.s = s
+        self.i = 0
+
+    def whitespace(self):
+        while self.i < len(self.s) and self.s[self.i].isspace():
+            self.i += 1
+
+    def word(self):
+        start = self.i
+        while self.i < len(self.s):
+            if self.s[self.i].isalnum() or self.s[self.i] in "#-.%":
+                self.i += 1
+            else:
+                break
+        if not (self.i > start):
+            raise Exception("Parsing error")
+        return self.s[start:self.i]
+
+    def literal(self, literal):
+        if self.i >= len(self.s) or self.s[self.i] != literal:
+            raise Exception("Parsing Error")
+        self.i += 1
+
+    def pair(self):
+        self.whitespace()
+        prop = self.word()
+        self.whitespace()
+        self.literal(":")
+        self.whitespace()
+        val = self.word()
+        return prop.casefold(), val
+
+    def body(self):
+        pairs = {}
+        while self.i < len(self.s) and self.s[self.i] != "}":
+            try:
+                prop, val = self.pair()
+                pairs[prop.casefold()] = val
+                self.whitespace()
+                self.literal(";")
+                self.whitespace()
+            except Exception:
+                why = self.ignore_until([";", "}"])
+                if why == ";":
+                    self.literal(";")
+                    self.whitespace()
+                else:
+                    break
+        return pairs
+
+    def ignore_until(self, chars):
+        while self.i < len(self.s):
+            if self.s[self.i] in chars:
+                return self.s[self.i]
+            else:
+                self.i += 1
+        return None
+
+    def selector(self):
+        out = TagSelector(self.word().casefold())
+        self.whitespace()
+        while self.i < len(self.s) and self.s[self.i] != "{":
+            out = DescendantSelector(out, TagSelector(self.word().casefold()))
+            self.whitespace()
+        return out
+
+    def parse(self):
+        rules = []
+        while self.i < len(self.s):
+            try:
+                self.whitespace()
+                selector = self.selector()
+                self.literal("{")
+                self.whitespace()
+                body = self.body()
+                self.literal("}")
+                rules.append((selector, body))
+            except Exception:
+                why = self.ignore_until(["}"])
+                if why == "}":
+                    self.literal("}")
+                    self.whitespace()
+                else:
+                    break
+        return rules
+
+
+def bench_css(args):
+    """Style sheet parsing throughput, character by character vs. regex tokens, and the inline style memo"""
+    sheets = [("synthetic", synthetic_stylesheet(args.rules * 10))]
+    for path in args.files:
+        with open(path, encoding="utf8") as f:
+            sheets.append((path, f.read()))
+
+    print("{:<20} {:>9} {:>9} {:>10} {:>10} {:>9}".format("sheet", "KB", "rules", "MB/s char", "MB/s regex", "speedup"))
+    for name, source in sheets:
+        timings, results = [], []
+        for parser in [CharCSSParser, CSSParser]:
+            start = time.perf_counter()
+            rules = parser(source).parse()
+            timings.append(time.perf_counter() - start)
+            results.append(compile_rules(rules))
+        assert results[0] == results[1], "regex parser changed the parsed rules"
+        mb = len(source.encode("utf8")) / 1e6
+        print("{:<20} {:>9.1f} {:>9} {:>10.2f} {:>10.2f} {:>8.1f}x".format(
+            name[-20:], mb * 1000, len(results[1]), mb / timings[0], mb / timings[1], timings[0] / timings[1]))
+
+    # style attributes: a few distinct strings repeated across many nodes
+    rng = random.Random(0)
+    distinct = ["{}: {}; {}: {};".format(PROPERTIES[i % 7], ["red", "12px", "bold"][i % 3], "color", ["blue", "green"][i % 2])
+                for i in range(50)]
+    attributes = [rng.choice(distinct) for _ in range(args.paragraphs * 100)]
+    INLINE_STYLES.clear()
+    timings = []
+    for parse in [lambda source: CSSParser(source).body(), inline_style]:
+        start = time.perf_counter()
+        for source in attributes:
+            parse(source)
+        timings.append((time.perf_counter() - start) * 1000)
+    print("inline styles: {} attributes, {} distinct, {:.1f} ms parsed each time, {:.1f} ms memoized".format(
+        len(attributes), len(distinct), timings[0], timings[1]))
+
+
+BENCHMARKS = {
+    "bloom": bench_bloom,
+    "cascade": bench_cascade,
+    "compact": bench_compact,
+    "css": bench_css,
+    "cull": bench_cull,
+    "deep": bench_deep,
+    "fonts": bench_fonts,
+    "hittest": bench_hittest,
+    "frames": bench_frames,
+    "lazy": bench_lazy,
+    "linebreak": bench_linebreak,
+    "measure": bench_measure,
+    "memory": bench_memory,
+    "parallel": bench_parallel,
+    "relayout": bench_relayout,
+    "resize": bench_resize,
+    "restyle": bench_restyle,
+    "retained": bench_retained,
+    "sharing": bench_sharing,
+    "typing": bench_typing,
+}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Rendering pipeline benchmarks.")
+    parser.add_argument("benchmark", choices=sorted(BENCHMARKS))
+    parser.add_argument("files", nargs="*", help="HTML files (CSS files for css) to use instead of the bundled/synthetic pages")
+    parser.add_argument("--paragraphs", type=int, default=500, help="size of the synthetic page")
+    parser.add_argument("--rules", type=int, default=2000, help="size of the synthetic style sheet")
+    parser.add_argument("--width", type=int, default=20, help="number of nested chains in deep documents")
+    parser.add_argument("--font-backend", choices=["truetype", "tk"], default="truetype")
+    args = parser.parse_args(argv)
+
+    if args.font_backend == "tk":
+        import tkinter
+        tkinter.Tk().withdraw()
+    font_metrics.set_backend(args.font_backend)
+    BENCHMARKS[args.benchmark](args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
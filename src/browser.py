@@ -1,25 +1,57 @@
 # Main browser GUI and rendering
 import tkinter
-from constants import WIDTH, HEIGHT, VSTEP, SCROLL_STEP
+from constants import WIDTH, HEIGHT, VSTEP, SCROLL_STEP, DOM_CACHE_BUDGET, DOM_SNAPSHOT_DIR, STYLESHEET_CACHE_SIZE, LAZY_LAYOUT_MARGIN
 # from layout import Layout
 # from layout_tree_simple import Layout # Use tree based layout instead of normal lexer based
-from layout_tree import DocumentLayout, Element, Text, get_font, DrawText, DrawRect, Rect # Use tree based layout instead of normal lexer based
+from layout_tree import DocumentLayout, LineLayout, Element, Text, DrawText, DrawRect, Rect # Use tree based layout instead of normal lexer based
 # from lexer import lex
-from parser import HTMLParser, print_tree
-from css_parser import style, CSSParser
-from utils import tree_to_list, cascade_priority
+from parser import print_tree
+from css_parser import style, restyle, mark_rules_dirty, RuleMap
+from utils import cascade_priority
+from traversal import preorder, select
 from url import URL
+from dom_cache import DOMCache
+from stylesheet_cache import StylesheetCache
+from display_list import DisplayList, compact
+from canvas_layer import RetainedLayer
+from frame_scheduler import FrameScheduler
+from hit_test import HitTestIndex
+from font_registry import get_font
 
-# default user-agent style sheet
-DEFAULT_STYLE_SHEET = CSSParser(open("user_agent.css").read()).parse()
+# parsed documents, so that revisits and go_back() skip HTML parsing
+DOM_CACHE = DOMCache(DOM_CACHE_BUDGET, DOM_SNAPSHOT_DIR)
 
+# parsed style sheets (user-agent one included, loaded on first use) and their rule maps
+STYLESHEET_CACHE = StylesheetCache(STYLESHEET_CACHE_SIZE)
 
-def paint_tree(layout_object, display_list):
-    """Helper function to recursively call paint() on all layout objects"""
-    display_list.extend(layout_object.paint()) # call paint before calling paint_tree recursively -> subtree paints on top of curr_node
 
-    for child in layout_object.children:
-        paint_tree(child, display_list)
+def load_stylesheets(nodes, url):
+    """Collects the user-agent rules and every linked style sheet of the document into a RuleMap"""
+    # apply default (from user-agent) style sheets
+    sheets = [STYLESHEET_CACHE.user_agent()]
+
+    links = []
+
+    # parsing <link rel="stylesheet" href="/main.css"> ...
+    for node in select(nodes, lambda node: isinstance(node, Element) and node.tag == "link"):
+        if node.attributes.get("rel") == "stylesheet" and "href" in node.attributes:
+            links.append(node.attributes["href"])
+
+    for link in links:
+        style_url = url.resolve(link)
+        try:
+            body = style_url.request()
+        except:        
+            continue
+        sheets.append(STYLESHEET_CACHE.parse(style_url, body)) # parsed once per URL and content
+
+    return STYLESHEET_CACHE.rule_map(sheets) # rules bucketed by their rightmost selector, in cascade order
+
+
+def paint_tree(layout_object, display_list):
+    """Helper function to call paint() on all layout objects"""
+    for obj in preorder(layout_object): # parents before children -> subtree paints on top of curr_node
+        display_list.extend(obj.paint())
 
 
 class DrawOutline:
@@ -28,14 +60,15 @@ class DrawOutline:
         self.color = color
         self.thickness = thickness
 
-    def execute(self, scroll, canvas):
-        canvas.create_rectangle(
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_rectangle(
             self.rect.left,
             self.rect.top - scroll,
             self.rect.right,
             self.rect.bottom - scroll,
             width = self.thickness,
-            outline = self.color
+            outline = self.color,
+            tags = tags
         )
 
 class DrawLine:
@@ -44,14 +77,15 @@ class DrawLine:
         self.color = color
         self.thickness = thickness
 
-    def execute(self, scroll, canvas):
-        canvas.create_line(
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_line(
             self.rect.left,
             self.rect.top - scroll,
             self.rect.right,
             self.rect.bottom - scroll,
             fill = self.color,
-            width = self.thickness
+            width = self.thickness,
+            tags = tags
         )
 
 
@@ -89,13 +123,31 @@ class Chrome:
         self.address_rect = Rect(
             self.back_rect.top + self.padding, # left
             self.urlbar_top + self.padding, # top
-            WIDTH - self.padding, # right
+            self.browser.width - self.padding, # right
             self.urlbar_bottom - self.padding # bottom
         )
 
         self.focus = None
         self.address_bar = ""
 
+        self.items = [] # (command, canvas item) of what's on the canvas
+        self.damage = [self.area()] # rects to paint again on the next draw()
+
+    def area(self):
+        return Rect(0, 0, self.browser.width, self.bottom)
+
+    def address_field(self):
+        """What editing the address bar changes: the field, and text running past its end"""
+        return Rect(self.address_rect.left, self.address_rect.top, float("inf"), self.address_rect.bottom)
+
+    def invalidate(self, rect=None):
+        """Marks a part (all by default) of the chrome to be painted again"""
+        self.damage.append(self.area() if rect is None else rect)
+
+    def resize(self, width):
+        self.address_rect.right = width - self.padding
+        self.invalidate()
+
 
     def tab_rect(self, i):
         tabs_start = self.newtab_rect.right + self.padding
@@ -109,6 +161,7 @@ class Chrome:
     
 
     def click(self, x, y):
+        self.invalidate() # focus, tabs or page may change
         self.focus = None
         if self.newtab_rect.contains_point(x, y):
             self.browser.new_tab(URL("https://browser.engineering/chrome.html"))
@@ -126,26 +179,29 @@ class Chrome:
     def keypress(self, char):
         if self.focus == "address_bar":
             self.address_bar += char
+            self.invalidate(self.address_field())
 
 
     def enter(self):
         if self.focus == "address_bar":
             self.browser.active_tab.load(URL(self.address_bar))
             self.focus = None
+            self.invalidate(self.address_field())
 
     def backspace(self):
         if self.focus == "address_bar":
             self.address_bar = self.address_bar[:-1]
+            self.invalidate(self.address_field())
     
 
     def paint(self):
         cmnds = []
 
         cmnds.append(DrawRect(
-            Rect(0, 0, WIDTH, self.bottom), "white"
+            Rect(0, 0, self.browser.width, self.bottom), "white"
         ))
         cmnds.append(DrawLine(
-            0, self.bottom, WIDTH, self.bottom, "black", 1
+            0, self.bottom, self.browser.width, self.bottom, "black", 1
         ))
 
         cmnds.append(DrawOutline(self.newtab_rect, "black", 1))
@@ -181,7 +237,7 @@ class Chrome:
                 ))
 
                 cmnds.append(DrawLine(
-                    bounds.right, bounds.bottom, WIDTH, bounds.bottom, "black", 1
+                    bounds.right, bounds.bottom, self.browser.width, bounds.bottom, "black", 1
                 ))
 
         cmnds.append(DrawOutline(
@@ -235,6 +291,24 @@ class Chrome:
 
         return cmnds
 
+    def draw(self, canvas):
+        """Paints the damaged parts of the chrome again, its other canvas items are kept. The commands
+        inside a damaged rect get new items, on top of the ones around them."""
+        if not self.damage:
+            return
+        damage, self.damage = self.damage, []
+
+        def damaged(cmnd):
+            return any(rect.contains(cmnd.rect) for rect in damage)
+
+        gone = [item for cmnd, item in self.items if damaged(cmnd)]
+        if gone:
+            canvas.delete(*gone)
+        self.items = [(cmnd, item) for cmnd, item in self.items if not damaged(cmnd)]
+        for cmnd in self.paint():
+            if damaged(cmnd):
+                self.items.append((cmnd, cmnd.execute(0, canvas, tags=("chrome",))))
+
 
 
     
@@ -244,17 +318,27 @@ class Browser:
     def __init__(self):
         self.tabs = []
         self.active_tab = None
+
+        # current window size, WIDTH x HEIGHT until the user resizes it
+        self.width = WIDTH
+        self.height = HEIGHT
+        self.pending_size = None # latest size from <Configure> not applied yet
         
         self.window = tkinter.Tk()
         self.canvas = tkinter.Canvas(
             self.window, 
             width=WIDTH,
             height=HEIGHT,
-            bg="white"
+            bg="white",
+            highlightthickness=0 # so the canvas size is exactly the drawable area
         )
-        self.canvas.pack()
+        self.canvas.pack(fill=tkinter.BOTH, expand=True)
+        self.canvas.bind("<Configure>", self.handle_configure)
 
         self.chrome = Chrome(self)
+        self.content = RetainedLayer(self.canvas, "content", below="chrome") # the active tab's page
+        self.frames = FrameScheduler(self.window, self.frame)
+        self.page_changed = False # something the next frame has to draw besides the chrome
         
         # bind the down arrow key to scroll
         self.window.bind("<Down>", self.handle_down)
@@ -269,19 +353,22 @@ class Browser:
 
 
     def new_tab(self, url):
-        new_tab = Tab(HEIGHT - self.chrome.bottom)
+        new_tab = Tab(self.height - self.chrome.bottom, self.width)
         new_tab.load(url)
         self.active_tab = new_tab
         self.tabs.append(new_tab)
-        self.draw()
+        self.chrome.invalidate()
+        self.request_frame()
+
+    # input handlers only change state; what they change is drawn by the next frame
     
     def handle_down(self, e):
         self.active_tab.scrolldown()
-        self.draw()
+        self.request_frame() # a held down key scrolls several steps per frame
 
     def handle_up(self, e):
         self.active_tab.scrollup()
-        self.draw()
+        self.request_frame()
 
     def handle_click(self, e):
         if e.y < self.chrome.bottom:
@@ -289,7 +376,8 @@ class Browser:
         else:
             tab_y = e.y - self.chrome.bottom
             self.active_tab.click(e.x, tab_y)
-        self.draw()
+            self.chrome.invalidate(self.chrome.address_field()) # a link changes the URL
+        self.request_frame()
 
     def handle_key(self, e):
         if len(e.char) == 0:
@@ -298,29 +386,58 @@ class Browser:
             return
         
         self.chrome.keypress(e.char)
-        self.draw()
+        self.request_frame(page=False) # only the address field, the page isn't touched
 
     def handle_enter(self, e):
         self.chrome.enter()
-        self.draw()
+        self.request_frame()
 
     def handle_backspace(self, e):
         self.chrome.backspace()
+        self.request_frame(page=False)
+
+    def handle_configure(self, e):
+        if (e.width, e.height) == (self.pending_size or (self.width, self.height)):
+            return
+        # a drag sends a burst of events: only the latest size is reflowed, by the next frame
+        self.pending_size = (e.width, e.height)
+        self.request_frame()
+
+    def request_frame(self, page=True):
+        """Asks for a frame; `page` if the page changed too, not only the chrome"""
+        self.page_changed = self.page_changed or page
+        self.frames.request()
+
+    def frame(self):
+        """Draws what the input handled since the last frame changed, called by the frame scheduler"""
+        if self.pending_size is not None:
+            self.resize()
         self.draw()
 
-    def draw(self):
-        self.canvas.delete("all")
-        self.active_tab.draw(self.canvas, self.chrome.bottom)
+    def resize(self):
+        size, self.pending_size = self.pending_size, None
+        if size == (self.width, self.height):
+            return # dragged back to where it was before the frame
+        self.width, self.height = size
+        self.chrome.resize(self.width) # the active tab is reflowed by draw(), the others when they're shown
 
-        # draw the tabs after main content
-        for cmnd in self.chrome.paint():
-            cmnd.execute(0, self.canvas)
+    def draw(self):
+        if self.active_tab is None:
+            self.content.clear()
+            return
+        # the chrome first: the page's items are kept below its items
+        self.chrome.draw(self.canvas) # only what changed since the last frame
+        if not self.page_changed:
+            return
+        self.page_changed = False
+        self.active_tab.resize(self.width, self.height - self.chrome.bottom) # lays out what comes into view
+        self.active_tab.draw(self.content, self.chrome.bottom) # page items are kept, only moved and completed
     
 
 
 
 class Tab:
-    def __init__(self, tab_height):
+    def __init__(self, tab_height, width=WIDTH):
         # click handling
         self.url = None # for storing the current page's URL
 
@@ -329,6 +446,7 @@ class Tab:
 
         # changes for accounting for tab
         self.tab_height = tab_height # tab height means the height of the remaining window after the bar on top (and not the height of the "tab")
+        self.width = width
 
         self.history = []
 
@@ -347,43 +465,51 @@ class Tab:
         self.url = url
         self.history.append(url)
         body = url.request()
-        self.nodes = HTMLParser(body).parse()
+        self.nodes = DOM_CACHE.parse(body) # same body as before -> a copy of its tree, without re-parsing
         # self.display_list = Layout(self.nodes).display_list
         # self.draw()
 
-        # apply default (from user-agent) style sheets
-        rules = DEFAULT_STYLE_SHEET.copy()
-
-        links = []
-
-        # parsing <link rel="stylesheet" href="/main.css"> ...
-        for node in tree_to_list(self.nodes, []):
-            if isinstance(node, Element) and node.tag == "link" and node.attributes.get("rel") == "stylesheet" and "href" in node.attributes:
-                links.append(node.attributes["href"])
-
-        for link in links:
-            # print(f"css links: {link}")
-            style_url = url.resolve(link)
-            try:
-                body = style_url.request()
-            except:        
-                continue
-            rule = CSSParser(body).parse()
-            # for property, value in rules:
-                # print(f"{property} -> {value}")
-            rules.extend(rule)
-
-        style(self.nodes, sorted(rules, key=cascade_priority)) # cascading, file-order acts as tie-breaker (as required) (python sorted works like that)
-        
-        self.document = DocumentLayout(self.nodes) # constructing layout objects
-        self.document.layout() # actually laying out "layout objects" earlier constructed
+        self.rules = load_stylesheets(self.nodes, url)
+        style(self.nodes, self.rules)
+        self.document = DocumentLayout(self.nodes, self.width) # constructing layout objects
+        self.render()
+
+    def render(self):
+        """Lays out and paints the (already styled) document, laying out again only what changed.
+
+        Only the part down to a margin below the viewport gets its real layout, the rest of the
+        page has estimated heights until scrolling gets near it."""
+        anchor = self.document.anchor_at(self.scroll) if self.document.height is not None else None
+        self.layout_stats = self.document.layout(self.needed_bottom() + LAZY_LAYOUT_MARGIN) # layout objects touched by this update
+        self.keep_anchor(anchor)
+        while not self.document.covers(self.needed_bottom()): # anchoring moved the viewport further down
+            for key, count in self.document.layout(self.needed_bottom() + LAZY_LAYOUT_MARGIN).items():
+                self.layout_stats[key] += count
+            self.keep_anchor(anchor)
         # print_tree(self.document.node)
-        self.display_list = []
-        paint_tree(self.document, self.display_list)
+        display_list = []
+        paint_tree(self.document, display_list)
+        self.paint_stats = {"painted": len(display_list)}
+        display_list = compact(display_list) # fewer commands, so fewer canvas items
+        self.paint_stats["commands"] = len(display_list)
+        self.display_list = DisplayList(display_list) # indexed, to draw only what's in view
+        self.hit_index = HitTestIndex(self.document) # for this layout, filled in by clicks
         # self.draw()
 
+    def add_stylesheet(self, rules):
+        """Adds rules that arrived after the page was loaded, restyling only the nodes they may apply to"""
+        self.rules = RuleMap(sorted(self.rules.rules + rules, key=cascade_priority))
+        mark_rules_dirty(self.nodes, rules)
+        self.restyle()
+
+    def restyle(self):
+        """Restyles the nodes marked dirty since the last style pass (e.g. by Element.set_attribute)"""
+        self.restyle_stats = restyle(self.nodes, self.rules) # nodes visited / restyled by this update
+        self.render()
+
     
-    def draw(self, canvas, offset):
+    def draw(self, layer, offset):
+        """Shows the part of the page in view through a RetainedLayer, at canvas y = offset"""
         # self.canvas.delete("all") # delete the old text before drawing new one, o/w it will lead to blackboxes eventually
         # for x, y, c, font in self.display_list:
 
@@ -392,18 +518,39 @@ class Tab:
         #     if y + VSTEP < self.scroll: continue
 
         #     self.canvas.create_text(x, y - self.scroll, text=c, anchor="nw", font=font) # anchor = "nw" -> tells tkinter that the coordinates are the top-left (northwest), and not the center as assumed in default
-        for cmnd in self.display_list:
-            if cmnd.rect.top > self.scroll + self.tab_height:
-                continue
-            if cmnd.rect.bottom < self.scroll:
-                continue
-            cmnd.execute(self.scroll - offset, canvas)
+        layer.draw(self.display_list, self.scroll, self.tab_height, offset)
+
+
+
+    def needed_bottom(self):
+        """How far down the document must have its real layout for the current scroll position"""
+        return self.scroll + self.tab_height + LAZY_LAYOUT_MARGIN
+
+    def max_scroll(self):
+        return max(self.document.height + 2*VSTEP - self.tab_height, 0)
 
+    def keep_anchor(self, anchor):
+        """Scroll anchoring: scrolls so that what was at the top of the viewport before a layout still
+        is, whatever changed height above it (estimates replaced by real layout, reflow, restyle)"""
+        if anchor is not None:
+            y = self.document.anchor_y(anchor)
+            if y is not None:
+                self.scroll = y
+        self.scroll = min(self.scroll, self.max_scroll())
 
+    def resize(self, width, tab_height):
+        """Fits the tab to a new window size, reflowing the document if the width changed"""
+        self.tab_height = tab_height
+        if width != self.width:
+            self.width = width
+            self.document.resize(width)
+            self.render() # styles, fonts and word widths are reused, only lines and positions are redone
+        elif not self.document.covers(self.needed_bottom()):
+            self.render() # a taller window shows more of the page
+        self.scroll = min(self.scroll, self.max_scroll())
 
     def scrolldown(self):
-        max_y = max(self.document.height + 2*VSTEP - self.tab_height, 0)
-        self.scroll = min(self.scroll + SCROLL_STEP, max_y)
+        self.scroll = min(self.scroll + SCROLL_STEP, self.max_scroll()) # the next frame lays out what comes into view (see resize())
         # self.draw()
 
 
@@ -416,16 +563,16 @@ class Tab:
     def click(self, x, y):
         y += self.scroll 
 
-        objs = []
-        for obj in tree_to_list(self.document, []):
-            if obj.x <= x < obj.x + obj.width and obj.y <= y < obj.y + obj.height:
-                objs.append(obj)
+        # the deepest object under the point is the one painted on top
+        hit = self.hit_index.hit(x, y)
 
         # clicked on empty space
-        if not objs:
+        if hit is None:
             return
         
-        elt = objs[-1].node
+        elt = hit.node
+        if isinstance(hit, LineLayout):
+            elt = hit.node_at(x) or elt # the word's Text node, words aren't layout objects
 
         while elt:
             if isinstance(elt, Text):
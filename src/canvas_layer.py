@@ -0,0 +1,72 @@
+# Retained canvas items: what's on screen stays on the canvas across frames instead of being drawn again
+from bisect import bisect_right
+from constants import RETAINED_ITEMS_MARGIN
+
+
+class RetainedLayer:
+    """The canvas items of one display list (a page), all tagged `tag`, kept alive across frames.
+
+    Scrolling moves the existing items with one canvas.move(); only commands coming into view get new
+    items, and items scrolled more than RETAINED_ITEMS_MARGIN out of view are deleted. Items stay
+    stacked in paint order, below the items tagged `below` (which must be on the canvas)."""
+    def __init__(self, canvas, tag, below=None):
+        self.canvas = canvas
+        self.tag = tag
+        self.below = below
+        self.new_tag = tag + "-new" # items created by the current frame
+        self.display_list = None
+        self.items = {} # index of the command in the display list -> canvas item
+        self.shift = 0 # canvas y of the items = document y - shift
+        self.stats = {"frames": 0, "created": 0, "deleted": 0, "moved": 0}
+
+    def clear(self):
+        self.canvas.delete(self.tag)
+        self.stats["deleted"] += len(self.items)
+        self.items = {}
+        self.display_list = None
+
+    def draw(self, display_list, scroll, height, offset):
+        """Shows [scroll, scroll + height] of the page (a DisplayList) at canvas y = offset"""
+        self.stats["frames"] += 1
+        shift = scroll - offset
+        if display_list is not self.display_list: # painted again: none of the items can be kept
+            self.clear()
+            self.display_list = display_list
+            self.shift = shift
+        elif shift != self.shift:
+            self.canvas.move(self.tag, 0, self.shift - shift)
+            self.stats["moved"] += 1
+            self.shift = shift
+
+        # far out of view: recycled
+        keep = set(display_list.visible_indices(scroll - RETAINED_ITEMS_MARGIN, scroll + height + RETAINED_ITEMS_MARGIN))
+        gone = [i for i in self.items if i not in keep]
+        if gone:
+            self.canvas.delete(*[self.items.pop(i) for i in gone])
+            self.stats["deleted"] += len(gone)
+
+        # coming into view
+        commands = display_list.commands
+        new = [i for i in display_list.visible_indices(scroll, scroll + height) if i not in self.items]
+        if not new:
+            return
+        old = sorted(self.items)
+        for i in new:
+            self.items[i] = commands[i].execute(shift, self.canvas, tags=(self.tag, self.new_tag))
+        self.stats["created"] += len(new)
+        self.restack(new, old)
+        self.canvas.dtag(self.new_tag, self.new_tag)
+
+    def restack(self, new, old):
+        """New items are created on top; moves those painted before older items below them"""
+        if old and new[-1] < old[0]: # scrolling up: everything new comes before what's there
+            self.canvas.tag_lower(self.new_tag, self.items[old[0]])
+            return
+        if self.below is not None: # on top of the old items, under the `below` ones
+            self.canvas.tag_lower(self.new_tag, self.below)
+        if not old or new[0] > old[-1]:
+            return # scrolling down: everything new comes after what's there
+        for i in new:
+            above = bisect_right(old, i)
+            if above < len(old):
+                self.canvas.tag_lower(self.items[i], self.items[old[above]])
@@ -17,4 +17,35 @@ INHERITED_PROPERTIES = {
     "font-style": "normal",
     "font-weight": "normal",
     "color": "black"
-}
\ No newline at end of file
+}
+
+# parsed-DOM cache (see dom_cache.py)
+DOM_CACHE_BUDGET = 32 * 1024 * 1024 # bytes of parsed trees kept in memory
+DOM_SNAPSHOT_DIR = None # directory for on-disk DOM snapshots, None disables them
+
+# font metrics (see font_metrics.py)
+FONT_BACKEND = "tk" # "tk" needs a display, "truetype" reads .ttf files and works headless
+FONT_FAMILIES = ["DejaVu Sans", "Liberation Sans", "Arial", "Helvetica", "FreeSans", "Noto Sans", "Lato"] # preferred, in order
+PIXELS_PER_POINT = 96 / 72 # Tk's default scaling
+MEASURE_CACHE_SIZE = 100000 # (font, word) widths remembered by the measurement cache
+FONT_REGISTRY_SIZE = 64 # fonts kept alive by the font registry (see font_registry.py)
+MIN_FONT_SIZE, MAX_FONT_SIZE = 4, 200 # point sizes fonts are clamped to
+ANCESTOR_FILTER_BITS = 12 # counting Bloom filter of ancestor tags has 2**12 slots (see css_parser.py)
+STYLESHEET_CACHE_SIZE = 64 # parsed style sheets (and rule maps) kept in memory (see stylesheet_cache.py)
+INLINE_STYLE_CACHE_SIZE = 4096 # distinct style="..." strings whose parsed declarations are memoized
+LINE_BREAK_MIN_RUN = 8 # runs of at least this many same-font words are broken into lines with prefix sums
+
+# lazy layout (see DocumentLayout.layout): blocks below the viewport get an estimated height
+LAZY_LAYOUT_MARGIN = HEIGHT # laid out at least this far below the viewport, extended two margins at a time
+ESTIMATED_CHAR_WIDTH = 8 # average width of a character of text, in pixels
+ESTIMATED_LINE_HEIGHT = 22 # lines of text, in pixels
+
+# parallel layout (see parallel_layout.py)
+PARALLEL_LAYOUT_MIN_NODES = 2000 # smaller subtrees cost more to send to a worker process than to lay out
+PARALLEL_LAYOUT_CHUNKS = 4 # jobs per worker process, so that uneven subtrees still keep every worker busy
+
+# drawing
+DISPLAY_LIST_BUCKET = 256 # height (in pixels) of the buckets of the display list's spatial index (see display_list.py)
+RETAINED_ITEMS_MARGIN = HEIGHT # canvas items scrolled further than this out of view are deleted (see canvas_layer.py)
+FRAME_RATE = 60 # frames per second the frame scheduler aims for (see frame_scheduler.py)
+FRAME_TIMES_KEPT = 120 # durations of the latest frames kept for the frame statistics
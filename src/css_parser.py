@@ -1,5 +1,11 @@
+import heapq
+import re
+import sys
 from layout_tree import Element
-from constants import INHERITED_PROPERTIES
+from parser import mark_style_dirty, mark_subtree_dirty, mark_layout_dirty
+from traversal import walk, preorder
+from constants import INHERITED_PROPERTIES, ANCESTOR_FILTER_BITS, INLINE_STYLE_CACHE_SIZE
+from utils import parse_font_size, parse_font_weight, parse_font_style, parse_color
 
 # Selectors Classes
 
@@ -7,8 +13,13 @@ class TagSelector:
     def __init__(self, tag):
         self.tag = tag
         self.priority = 1
+        self.bucket = ("tag", tag) # which RuleMap bucket rules ending in this selector go to
 
-    def matches(self, node):
+    def keys(self):
+        """Bucket keys a node needs to match this selector"""
+        return [self.bucket]
+
+    def matches(self, node, ancestors=None):
         return isinstance(node, Element) and self.tag == node.tag
     
 
@@ -18,10 +29,18 @@ class DescendantSelector:
         self.ancestor = ancestor
         self.descendant = descendant
         self.priority = ancestor.priority + descendant.priority # more specific rules to override more general ones
+        self.bucket = descendant.bucket # only the rightmost part decides which nodes are candidates
+        self.ancestor_keys = ancestor.keys() # must all be present among the node's ancestors
+
+    def keys(self):
+        return self.ancestor.keys() + self.descendant.keys()
 
-    def matches(self, node):
+    def matches(self, node, ancestors=None):
+        """`ancestors` is an optional AncestorFilter holding the ancestors of `node`"""
         if not self.descendant.matches(node):
             return False
+        if ancestors is not None and not all(ancestors.might_contain(key) for key in self.ancestor_keys):
+            return False # the ancestor is definitely not there, skip the walk to the root
         while node.parent:
             if self.ancestor.matches(node.parent):
                 return True
@@ -31,168 +50,435 @@ class DescendantSelector:
 
 # CSS Parser
 
+# token patterns: a word is a run of letters, digits and "#-.%"
+WORD = r"(?:[^\W_]|[#\-.%])+"
+WHITESPACE_RE = re.compile(r"\s*")
+DECLARATION_RE = re.compile(r"\s*(" + WORD + r")\s*:\s*(" + WORD + r")\s*") # property: value
+DECLARATIONS_RE = re.compile(r"(?:\s*" + WORD + r"\s*:\s*" + WORD + r"\s*;)*\s*") # a run of well-formed ones
+RULE_START_RE = re.compile(r"\s*(" + WORD + r"(?:\s+" + WORD + r")*)\s*\{\s*") # selector {
+SKIP_DECLARATION_RE = re.compile(r"[;}]")
+SKIP_RULE_RE = re.compile(r"}")
+
+# a whole well-formed rule in one match; a single character class is much faster than WORD's
+# alternation, but it also takes "_", so matches containing one go through the general path
+FAST_WORD = r"[\w#\-.%]+"
+FAST_PAIR_RE = re.compile(r"(" + FAST_WORD + r")\s*:\s*(" + FAST_WORD + r")")
+FAST_RULE_RE = re.compile(r"\s*(" + FAST_WORD + r"(?:\s+" + FAST_WORD + r")*)\s*\{((?:\s*" + FAST_WORD +
+                          r"\s*:\s*" + FAST_WORD + r"\s*;)*)\s*\}\s*")
+
+
 class CSSParser:
+    """Parses style sheets and declaration lists with compiled patterns, one match per token group.
+
+    Malformed declarations are skipped up to the next ";" (or the closing "}"), malformed rules up to
+    the next "}", the same recovery as the original character by character parser."""
     def __init__(self, s):
         self.s = s
         self.i = 0
 
     def whitespace(self):
-        while self.i < len(self.s) and self.s[self.i].isspace():
-            self.i += 1
-
-    def word(self):
-        start = self.i
-        while self.i < len(self.s):
-            if self.s[self.i].isalnum() or self.s[self.i] in "#-.%":
-                self.i += 1
-            else:
-                break
-        if not (self.i > start):
-            raise Exception("Parsing error")
-        return self.s[start:self.i]
-    
-    def literal(self, literal):
-        if self.i >= len(self.s) or self.s[self.i] != literal:
-            raise Exception("Parsing Error")
-        self.i += 1
-
-    def pair(self):
-        self.whitespace()
-        prop = self.word() # property
-        self.whitespace()
-        self.literal(":") # ":"
-        self.whitespace()
-        val = self.word() # value
-        return prop.casefold(), val
+        self.i = WHITESPACE_RE.match(self.s, self.i).end()
+
+    def ignore_until(self, pattern):
+        """Function to skip property-value pairs (or rules) that don't parse, returns the char it stopped at"""
+        match = pattern.search(self.s, self.i)
+        if match is None:
+            self.i = len(self.s)
+            return None
+        self.i = match.start()
+        return match.group()
     
     def body(self):
-        """returns a list of pair of `property-value`"""
+        """returns a dict of `property-value` pairs"""
         pairs = {}
+        s, n = self.s, len(self.s)
+
+        while self.i < n and s[self.i] != "}":
+            # fast path: every well-formed declaration up to the first malformed/unterminated one
+            end = DECLARATIONS_RE.match(s, self.i).end()
+            if end > self.i:
+                for prop, value in FAST_PAIR_RE.findall(s, self.i, end):
+                    pairs[prop.casefold()] = value
+                self.i = end
+                if self.i >= n or s[self.i] == "}":
+                    break
 
-        while self.i < len(self.s) and self.s[self.i] != "}":
-            try: # remove try (debugging)
-                prop, val = self.pair()
-                pairs[prop.casefold()] = val
-                self.whitespace()
-                self.literal(";")
-                self.whitespace()
-            except Exception:
-                why = self.ignore_until([";", "}"])
-                if why == ";":
-                    self.literal(";")
+            match = DECLARATION_RE.match(s, self.i)
+            if match:
+                pairs[match.group(1).casefold()] = match.group(2)
+                self.i = match.end()
+                if self.i < n and s[self.i] == ";":
+                    self.i += 1
                     self.whitespace()
-                else:
-                    break
-        
-        return pairs
-    
-    def ignore_until(self, chars):
-        """Function to skip property-value pairs that don't parse"""
-        while self.i < len(self.s):
-            if self.s[self.i] in chars:
-                return self.s[self.i]
-            else:
+                    continue
+
+            # malformed (or unterminated) declaration
+            why = self.ignore_until(SKIP_DECLARATION_RE)
+            if why == ";":
                 self.i += 1
+                self.whitespace()
+            else:
+                break
         
-        return None
+        return pairs
     
     # Selector related method
     
-    def selector(self):
-        """returns an object of type `TagSelector` with descendants (if any)"""
-        out = TagSelector(self.word().casefold())
-        self.whitespace()
-
-        while self.i < len(self.s) and self.s[self.i] != "{":
-            tag = self.word()
-            descendant = TagSelector(tag.casefold())
-            out = DescendantSelector(out, descendant)
-            self.whitespace()
-        
+    def selector(self, text):
+        """returns an object of type `TagSelector` with descendants (if any), for the text before "{" """
+        words = text.split() # the rule patterns only let whitespace through between the words
+        out = TagSelector(words[0].casefold())
+        for tag in words[1:]:
+            out = DescendantSelector(out, TagSelector(tag.casefold()))
         return out
     
 
     def parse(self):
         rules = []
+        s, n = self.s, len(self.s)
         
-        while self.i < len(self.s):
-            try:
+        while self.i < n:
+            match = FAST_RULE_RE.match(s, self.i)
+            if match and "_" not in match.group():
+                body = {}
+                for prop, value in FAST_PAIR_RE.findall(match.group(2)):
+                    body[prop.casefold()] = value
+                rules.append((self.selector(match.group(1)), body))
+                self.i = match.end()
+                continue
+
+            match = RULE_START_RE.match(s, self.i)
+            if match:
+                selector = self.selector(match.group(1)) # h, p, ul
+                self.i = match.end()
+                body = self.body() # "background-color": "blue"; ...;
+                if self.i < n: # body stops at the "}"
+                    self.i += 1
+                    rules.append((selector, body))
+                    continue
+                break # unterminated rule
+
+            # malformed selector: skip the whole rule
+            why = self.ignore_until(SKIP_RULE_RE)
+            if why == "}":
+                self.i += 1
                 self.whitespace()
-                selector = self.selector() # h, p, ul
+            else:
+                break
 
-                self.literal("{")
-                
-                self.whitespace()
-                body = self.body() # "background-color": "blue"; ...;
-                
-                self.literal("}")
+        return rules
 
-                rules.append((selector, body))
 
-            except Exception:
-                why = self.ignore_until(["}"])
-                if why == "}":
-                    self.literal("}")
-                    self.whitespace()
-                else:
-                    break
+INLINE_STYLES = {} # style="..." source -> parsed declarations, shared by every node using the same string
 
-        return rules
-    
 
-def style(node, rules):
-    # store CSS styles in node.style dictionary
-    node.style = {}
+def inline_style(source):
+    """Parsed declarations of a style attribute, memoized by their source (don't modify the result)"""
+    pairs = INLINE_STYLES.get(source)
+    if pairs is None:
+        if len(INLINE_STYLES) >= INLINE_STYLE_CACHE_SIZE:
+            INLINE_STYLES.clear() # simple bound, the common strings come right back
+        pairs = INLINE_STYLES[source] = CSSParser(source).body()
+    return pairs
 
-    # inheritence of styles from parent from font-size, font-weight...
-    for property, default_value in INHERITED_PROPERTIES.items():
-        if node.parent: # inherit from the parent (if present)
-            node.style[property] = node.parent.style[property]
-        else:
-            node.style[property] = default_value
 
-    # apply default rules (aka "user agent" style sheet. User agent, like the Memex)
-    for selector, body in rules:
-        if not selector.matches(node):
-            continue
-        for property, value in body.items():
-            node.style[property] = value
+def bucket_keys(node):
+    """The keys selectors can match a node by: its tag, id and classes"""
+    if not isinstance(node, Element):
+        return []
+    keys = [("tag", node.tag)]
+    if "id" in node.attributes:
+        keys.append(("id", node.attributes["id"]))
+    for cls in node.attributes.get("class", "").split():
+        keys.append(("class", cls))
+    return keys
 
 
-    # overwrite the default style sheets
-    if isinstance(node, Element) and "style" in node.attributes:
-        pairs = CSSParser(node.attributes["style"]).body()
-        for property, value in pairs.items():
-            node.style[property] = value
+# Ancestor filter
 
-    if node.style["font-size"].endswith("%"):
-        if node.parent:
-            parent_font_size = node.parent.style["font-size"]
-        else:
-            parent_font_size = INHERITED_PROPERTIES["font-size"]
+class AncestorFilter:
+    """Counting Bloom filter of the bucket keys (tags, ids, classes) of the current node's ancestors.
 
-        node_pct = float(node.style["font-size"][:-1]) / 100 # node %
-        parent_px = float(parent_font_size[:-2])
-        node.style["font-size"] = str(node_pct * parent_px) + "px"
-        
+    style() pushes a node before styling its children and pops it afterwards. might_contain() can
+    give false positives but never false negatives, so a miss lets a DescendantSelector bail out early."""
+    def __init__(self, bits=ANCESTOR_FILTER_BITS):
+        self.bits = bits
+        self.mask = (1 << bits) - 1
+        self.counts = [0] * (1 << bits)
 
-    # recurse through the HTML tree, to set all the children's style also the same
-    for child in node.children:
-        style(child, rules)
+    def slots(self, key):
+        h = hash(key)
+        return h & self.mask, (h >> self.bits) & self.mask # two hash functions from one hash
 
+    def push(self, node):
+        for key in bucket_keys(node):
+            for slot in self.slots(key):
+                self.counts[slot] += 1
 
+    def pop(self, node):
+        for key in bucket_keys(node):
+            for slot in self.slots(key):
+                self.counts[slot] -= 1
 
+    def might_contain(self, key):
+        first, second = self.slots(key)
+        return self.counts[first] > 0 and self.counts[second] > 0
 
 
+# Rule map
 
+class RuleMap:
+    """Rules bucketed by their rightmost selector (tag, or id/class once supported), in cascade order.
 
-    
-    
+    Each node is only tested against the rules of its own buckets plus the universal ones."""
+    def __init__(self, rules):
+        self.rules = rules # sorted by cascade priority
+        self.buckets = {} # ("tag", "p") -> [(index, selector, body)]
+        self.universal = [] # rules without a bucket, candidates for every node
+        for index, (selector, body) in enumerate(rules):
+            bucket = getattr(selector, "bucket", None)
+            entry = (index, selector, body)
+            if bucket is None:
+                self.universal.append(entry)
+            else:
+                self.buckets.setdefault(bucket, []).append(entry)
+
+        self.stats = {"nodes": 0, "candidates": 0, "matches": 0}
+
+    def candidates(self, node):
+        """Rules that may match `node`, in cascade order"""
+        lists = [self.universal] if self.universal else []
+        for key in bucket_keys(node):
+            if key in self.buckets:
+                lists.append(self.buckets[key])
+
+        if not lists:
+            return []
+        if len(lists) == 1:
+            return lists[0]
+        return heapq.merge(*lists) # indices are unique, so the selectors are never compared
+
+    def matching(self, node, ancestors=None):
+        """(selector, body) of every rule matching `node`, in cascade order"""
+        self.stats["nodes"] += 1
+        for _, selector, body in self.candidates(node):
+            self.stats["candidates"] += 1
+            if selector.matches(node, ancestors):
+                self.stats["matches"] += 1
+                yield selector, body
+
+    def report(self):
+        nodes = self.stats["nodes"] or 1
+        return dict(
+            self.stats,
+            rules=len(self.rules),
+            buckets=len(self.buckets),
+            candidates_per_node=self.stats["candidates"] / nodes,
+            matches_per_node=self.stats["matches"] / nodes,
+        )
+
+
+# Computed styles
+
+class ComputedStyle(dict):
+    """A node's computed style. Read-only, since one object can be shared by many nodes.
+
+    Besides the string properties, holds typed values resolved once at cascade time for layout and paint."""
+    __slots__ = ("font_size", "weight", "slant", "color", "background_color")
+
+    def __init__(self, properties, font_size):
+        dict.__init__(self, properties)
+        self.font_size = font_size # pixels, em/% already resolved against the parent
+        self.weight = parse_font_weight(properties["font-weight"]) # "normal" or "bold"
+        self.slant = parse_font_style(properties["font-style"]) # "roman" or "italic"
+        self.color = parse_color(properties["color"])
+        self.background_color = parse_color(properties.get("background-color", "transparent")) # None if transparent
+
+    def _readonly(self, *args, **kwargs):
+        raise TypeError("computed styles are shared between nodes and can't be modified")
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _readonly
+
+
+class StyleSharingCache:
+    """Hands out one ComputedStyle to every node that is guaranteed to compute the same style.
+
+    That is nodes with the same tag, id and class, no inline style, and the same parent style object.
+    Since shared styles are only ever handed out under such a key, the same parent style object also
+    means the same chain of ancestor tags/ids/classes, so descendant selectors match the same way.
+    Text nodes simply use their parent's style. Only valid for a single style() pass."""
+    def __init__(self):
+        self.styles = {} # (id(parent style), tag, id, class) -> ComputedStyle
+        self.stats = {"computed": 0, "shared": 0, "text_shared": 0}
+
+    def key(self, node):
+        if "style" in node.attributes:
+            return None
+        parent_style = node.parent.style if node.parent else None
+        return (id(parent_style), node.tag, node.attributes.get("id"), node.attributes.get("class"))
+
+    def lookup(self, node):
+        if not isinstance(node, Element):
+            if node.parent:
+                self.stats["text_shared"] += 1
+                return node.parent.style
+            return None
+        key = self.key(node)
+        computed = self.styles.get(key) if key else None
+        if computed is not None:
+            self.stats["shared"] += 1
+        return computed
+
+    def store(self, node, computed):
+        self.stats["computed"] += 1
+        if isinstance(node, Element):
+            key = self.key(node)
+            if key:
+                self.styles[key] = computed
+        return computed
+
+    def report(self):
+        nodes = self.stats["computed"] + self.stats["shared"] + self.stats["text_shared"]
+        sizes = [sys.getsizeof(computed) for computed in self.styles.values()]
+        avg_size = sum(sizes) / len(sizes) if sizes else 0
+        return dict(
+            self.stats,
+            nodes=nodes,
+            unique_styles=len(self.styles),
+            sharing_ratio=(nodes - self.stats["computed"]) / nodes if nodes else 0.0,
+            bytes_saved=int(avg_size * (nodes - self.stats["computed"])), # rough, one style dict per node otherwise
+        )
+
+
+def compute_style(node, rules, ancestors):
+    computed = {}
 
+    # inheritence of styles from parent from font-size, font-weight...
+    for property, default_value in INHERITED_PROPERTIES.items():
+        if node.parent: # inherit from the parent (if present)
+            computed[property] = node.parent.style[property]
+        else:
+            computed[property] = default_value
 
-    
+    # apply default rules (aka "user agent" style sheet. User agent, like the Memex)
+    for selector, body in rules.matching(node, ancestors):
+        for property, value in body.items():
+            computed[property] = value
 
-    
 
-    
+    # overwrite the default style sheets
+    if isinstance(node, Element) and "style" in node.attributes:
+        pairs = inline_style(node.attributes["style"])
+        for property, value in pairs.items():
+            computed[property] = value
+
+    # resolve em/% against the parent, children inherit the size in pixels
+    if node.parent:
+        parent_px = node.parent.style.font_size
+    else:
+        parent_px = parse_font_size(INHERITED_PROPERTIES["font-size"])
+    font_size = parse_font_size(computed["font-size"], parent_px)
+    computed["font-size"] = "{:g}px".format(font_size)
+
+    return ComputedStyle(computed, font_size)
+
+
+def style(root, rules, ancestors=None, sharing=None):
+    if not isinstance(rules, RuleMap):
+        rules = RuleMap(rules) # compile once at the root, children reuse it
+    if ancestors is None:
+        ancestors = AncestorFilter()
+    if sharing is None:
+        sharing = StyleSharingCache()
+
+    # walk the whole HTML tree, parents before children, so inherited values are always ready
+    for node, entering in walk(root):
+        if not entering:
+            ancestors.pop(node)
+            continue
 
+        # store CSS styles in node.style dictionary, reusing a sibling's/cousin's when it must be identical
+        node.style = sharing.lookup(node)
+        if node.style is None:
+            node.style = sharing.store(node, compute_style(node, rules, ancestors))
+        node.style_dirty = node.child_dirty = False
+        ancestors.push(node)
+
+
+# Incremental restyle
+
+def dirty_children(node):
+    """The children restyle() has to visit: those that are dirty or have a dirty descendant"""
+    if not node.child_dirty:
+        return ()
+    return [child for child in node.children if child.style_dirty or child.child_dirty]
+
+
+def restyle(root, rules, ancestors=None, sharing=None, stats=None):
+    """Restyles only the nodes marked dirty (see parser.mark_style_dirty), visiting only the paths to them.
+
+    Returns counters: nodes visited and nodes restyled."""
+    if not isinstance(rules, RuleMap):
+        rules = RuleMap(rules)
+    if ancestors is None:
+        ancestors = AncestorFilter()
+        for ancestor in reversed(list(node_ancestors(root))):
+            ancestors.push(ancestor)
+    if sharing is None:
+        sharing = StyleSharingCache()
+    if stats is None:
+        stats = {"visited": 0, "restyled": 0}
+
+    for node, entering in walk(root, dirty_children):
+        if entering:
+            restyle_node(node, rules, ancestors, sharing, stats)
+            if node.child_dirty:
+                ancestors.push(node)
+        elif node.child_dirty: # leaving a node whose dirty children were all visited
+            node.child_dirty = False
+            ancestors.pop(node)
+
+    return stats
+
+
+def restyle_node(node, rules, ancestors, sharing, stats):
+    stats["visited"] += 1
+    if node.style_dirty:
+        old_style = getattr(node, "style", None)
+        node.style = sharing.lookup(node)
+        if node.style is None:
+            node.style = sharing.store(node, compute_style(node, rules, ancestors))
+        node.style_dirty = False
+        stats["restyled"] += 1
+
+        if node.style != old_style:
+            mark_layout_dirty(node) # fonts, and so line breaks, may have changed
+
+        if node.style is not old_style:
+            for child in node.children:
+                if not isinstance(child, Element):
+                    child.style = node.style # Text nodes always follow their parent
+                elif node.style != old_style:
+                    child.style_dirty = True # inherited values changed
+                    node.child_dirty = True
+
+
+def node_ancestors(node):
+    while node.parent:
+        node = node.parent
+        yield node
+
+
+def mark_rules_dirty(root, changed_rules):
+    """Marks the nodes that added or removed rules may apply to, i.e. those in the rules' buckets"""
+    buckets = set()
+    for selector, _ in changed_rules:
+        bucket = getattr(selector, "bucket", None)
+        if bucket is None:
+            mark_subtree_dirty(root) # universal rule, anything may change
+            return
+        buckets.add(bucket)
+
+    for node in preorder(root):
+        if any(key in buckets for key in bucket_keys(node)):
+            mark_style_dirty(node)
\ No newline at end of file
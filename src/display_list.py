@@ -0,0 +1,110 @@
+# Display list with a spatial index, so that drawing a frame only looks at what's on screen
+from layout_tree import DrawText, DrawRect, FONTS
+from constants import DISPLAY_LIST_BUCKET
+
+
+class DisplayList:
+    """Paint commands in paint order, bucketed by vertical extent.
+
+    Bucket i holds the commands overlapping [i * DISPLAY_LIST_BUCKET, (i + 1) * DISPLAY_LIST_BUCKET),
+    so finding what intersects the viewport only reads the few buckets the viewport overlaps,
+    whatever the length of the page."""
+    def __init__(self, commands):
+        self.commands = commands
+        self.buckets = []
+        for i, cmnd in enumerate(commands):
+            first = int(max(cmnd.rect.top, 0)) // DISPLAY_LIST_BUCKET
+            last = int(max(cmnd.rect.bottom, 0)) // DISPLAY_LIST_BUCKET
+            if last >= len(self.buckets):
+                self.buckets.extend([] for _ in range(last + 1 - len(self.buckets)))
+            for bucket in range(first, last + 1):
+                self.buckets[bucket].append(i)
+
+    def __len__(self):
+        return len(self.commands)
+
+    def __iter__(self):
+        return iter(self.commands)
+
+    def visible(self, top, bottom):
+        """The commands intersecting [top, bottom], in paint order"""
+        commands = self.commands
+        return [commands[i] for i in self.visible_indices(top, bottom)]
+
+    def visible_indices(self, top, bottom):
+        """Indices (in paint order) of the commands intersecting [top, bottom]"""
+        first = int(max(top, 0)) // DISPLAY_LIST_BUCKET
+        last = min(int(max(bottom, 0)) // DISPLAY_LIST_BUCKET, len(self.buckets) - 1)
+        if first == last:
+            found = self.buckets[first]
+        else:
+            found = set() # a command overlapping several buckets is in each of them
+            for bucket in range(first, last + 1):
+                found.update(self.buckets[bucket])
+            found = sorted(found)
+
+        commands = self.commands
+        visible = []
+        for i in found:
+            rect = commands[i].rect
+            if rect.top <= bottom and rect.bottom >= top:
+                visible.append(i)
+        return visible
+
+
+def compact(commands):
+    """Display list optimization run after paint_tree(), returns the new list of commands.
+
+    Words of a line one space apart in the same font and color become one DrawText (one canvas item,
+    its width from the measured words), and rects that are empty or under a later rect are dropped."""
+    covered = covered_rects(commands)
+    spaces = FONTS.spaces
+    compacted = []
+    run = [] # DrawTexts to merge
+    for i, cmnd in enumerate(commands):
+        if i in covered:
+            continue
+        if isinstance(cmnd, DrawText) and run:
+            last = run[-1]
+            if (cmnd.font is last.font and cmnd.color == last.color and cmnd.rect.top == last.rect.top
+                    and cmnd.rect.left == last.rect.right + spaces[FONTS.id(cmnd.font)]):
+                run.append(cmnd)
+                continue
+        if run:
+            compacted.append(merge_texts(run))
+        run = [cmnd] if isinstance(cmnd, DrawText) else []
+        if not run:
+            compacted.append(cmnd)
+    if run:
+        compacted.append(merge_texts(run))
+    return compacted
+
+
+def merge_texts(run):
+    first, last = run[0], run[-1]
+    if len(run) == 1:
+        return first
+    return DrawText(first.rect.left, first.rect.top, " ".join([cmnd.text for cmnd in run]), first.font, first.color,
+                    last.rect.right - first.rect.left, first.rect.bottom - first.rect.top)
+
+
+def covered_rects(commands):
+    """Indices of the DrawRects that are empty or entirely under a DrawRect painted later"""
+    covered = set()
+    later = {} # bucket -> rects painted later reaching into it
+    for i in range(len(commands) - 1, -1, -1):
+        cmnd = commands[i]
+        if not isinstance(cmnd, DrawRect):
+            continue
+        rect = cmnd.rect
+        if rect.right <= rect.left or rect.bottom <= rect.top:
+            covered.add(i)
+            continue
+        # a rect covering this one also reaches into the bucket of its top
+        first = int(max(rect.top, 0)) // DISPLAY_LIST_BUCKET
+        if any(other.contains(rect) for other in later.get(first, ())):
+            covered.add(i)
+            continue
+        for bucket in range(first, int(max(rect.bottom, 0)) // DISPLAY_LIST_BUCKET + 1):
+            later.setdefault(bucket, []).append(rect)
+    return covered
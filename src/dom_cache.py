@@ -0,0 +1,142 @@
+# Parsed-DOM cache, keyed by a content hash of the page body
+import hashlib
+import marshal
+import os
+import zlib
+from collections import OrderedDict
+from parser import HTMLParser, Text, Element
+
+SNAPSHOT_VERSION = 1
+NODE_OVERHEAD = 400 # rough size (in bytes) of one node object, its __dict__ and children list
+
+
+def content_hash(body):
+    """Returns a hex digest identifying the decoded page body"""
+    return hashlib.blake2b(body.encode("utf8", "surrogatepass"), digest_size=16).hexdigest()
+
+
+def encode_tree(root):
+    """Flattens a DOM tree into pre-order records: (tag, attributes, child_count) for Elements, str for Texts.
+    The records don't share anything with the tree, later changes to it don't reach them."""
+    records = []
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, Text):
+            records.append(node.text)
+        else:
+            records.append((node.tag, dict(node.attributes), len(node.children)))
+            stack.extend(reversed(node.children))
+    return records
+
+
+def decode_tree(records):
+    """Rebuilds the DOM tree from the records produced by encode_tree()"""
+    root = None
+    stack = [] # [element, children still to be attached]
+    for record in records:
+        parent = stack[-1][0] if stack else None
+        if isinstance(record, str):
+            node = Text(record, parent)
+        else:
+            tag, attributes, child_count = record
+            node = Element(tag, dict(attributes), parent)
+
+        if parent is None:
+            root = node
+        else:
+            parent.children.append(node)
+            stack[-1][1] -= 1
+
+        if isinstance(node, Element) and child_count:
+            stack.append([node, child_count])
+
+        # pop every element whose children are all attached
+        while stack and stack[-1][1] == 0:
+            stack.pop()
+    return root
+
+
+def estimate_size(body, records):
+    """Approximate memory held by a parsed tree"""
+    return len(body) + NODE_OVERHEAD * len(records)
+
+
+class DOMCache:
+    """Keeps recently parsed DOM trees in memory under a byte budget, optionally backed by snapshots on disk.
+
+    What's kept are the encode_tree() records, not trees: a tree holds the state of the tab that
+    loaded it (styles, dirty bits, DOM changes), so every parse() returns a tree of its own,
+    rebuilt from the records, which is still much cheaper than parsing."""
+    def __init__(self, budget, snapshot_dir=None):
+        self.budget = budget
+        self.snapshot_dir = snapshot_dir
+        self.entries = OrderedDict() # digest -> (records, size), least recently used first
+        self.size = 0
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0, "snapshot_errors": 0}
+
+    def parse(self, body):
+        """Returns a new DOM tree for `body`, running the HTML parser only if this body was never seen before"""
+        digest = content_hash(body)
+
+        if digest in self.entries:
+            self.stats["hits"] += 1
+            self.entries.move_to_end(digest)
+            return decode_tree(self.entries[digest][0])
+
+        records = self.read_snapshot(digest)
+        if records is not None:
+            self.stats["disk_hits"] += 1
+            tree = decode_tree(records)
+        else:
+            self.stats["misses"] += 1
+            tree = HTMLParser(body).parse()
+            records = encode_tree(tree)
+            self.write_snapshot(digest, records)
+
+        self.insert(digest, records, estimate_size(body, records))
+        return tree
+
+    def insert(self, digest, records, size):
+        if size > self.budget:
+            return # would evict everything else, not worth keeping in memory
+        self.entries[digest] = (records, size)
+        self.size += size
+        while self.size > self.budget:
+            _, (_, evicted_size) = self.entries.popitem(last=False)
+            self.size -= evicted_size
+            self.stats["evictions"] += 1
+
+    def clear(self):
+        self.entries.clear()
+        self.size = 0
+
+    # disk snapshots
+
+    def snapshot_path(self, digest):
+        return os.path.join(self.snapshot_dir, digest + ".dom")
+
+    def read_snapshot(self, digest):
+        if self.snapshot_dir is None:
+            return None
+        try:
+            with open(self.snapshot_path(digest), "rb") as f:
+                version, records = marshal.loads(zlib.decompress(f.read()))
+        except (OSError, ValueError, EOFError, TypeError, zlib.error):
+            return None # missing or corrupt snapshot, just parse again
+        if version != SNAPSHOT_VERSION:
+            return None
+        return records
+
+    def write_snapshot(self, digest, records):
+        if self.snapshot_dir is None:
+            return
+        try:
+            os.makedirs(self.snapshot_dir, exist_ok=True)
+            path = self.snapshot_path(digest)
+            data = zlib.compress(marshal.dumps((SNAPSHOT_VERSION, records)))
+            with open(path + ".tmp", "wb") as f:
+                f.write(data)
+            os.replace(path + ".tmp", path) # never leave a half written snapshot behind
+        except OSError:
+            self.stats["snapshot_errors"] += 1 # the tree is still cached in memory, next time is parsed again
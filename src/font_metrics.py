@@ -0,0 +1,344 @@
+# Font metrics providers: Tk fonts, or a pure Python reader for TrueType files (no display needed)
+import os
+import struct
+import tkinter
+import tkinter.font
+from collections import OrderedDict
+from constants import FONT_BACKEND, FONT_FAMILIES, PIXELS_PER_POINT, MEASURE_CACHE_SIZE
+
+
+class TkFontBackend:
+    """Fonts measured by Tk itself. Needs a display, and every measurement is a round trip into Tcl."""
+    name = "tk"
+
+    def create_font(self, size, weight, style):
+        return tkinter.font.Font(size=size, weight=weight, slant=style)
+
+
+# TrueType backend
+
+FONT_DIRS = [
+    "/usr/share/fonts",
+    "/usr/local/share/fonts",
+    os.path.expanduser("~/.fonts"),
+    os.path.expanduser("~/.local/share/fonts"),
+    "/Library/Fonts",
+    "/System/Library/Fonts",
+    os.path.expanduser("~/Library/Fonts"),
+    "C:\\Windows\\Fonts",
+]
+
+
+class FontFile:
+    """Reads the tables needed for text measurement from a TrueType/OpenType file"""
+    def __init__(self, path):
+        self.path = path
+        with open(path, "rb") as f:
+            self.data = f.read()
+
+        offset = 0
+        if self.data[:4] == b"ttcf": # font collection, use its first font
+            offset, = struct.unpack_from(">I", self.data, 12)
+
+        num_tables, = struct.unpack_from(">H", self.data, offset + 4)
+        self.tables = {}
+        for i in range(num_tables):
+            tag, _, table_offset, length = struct.unpack_from(">4sIII", self.data, offset + 12 + 16 * i)
+            self.tables[tag.decode("latin-1")] = (table_offset, length)
+
+        for required in ["head", "hhea", "hmtx", "cmap"]:
+            if required not in self.tables:
+                raise ValueError(f"{path} has no '{required}' table")
+
+        head = self.tables["head"][0]
+        self.units_per_em, = struct.unpack_from(">H", self.data, head + 18)
+
+        hhea = self.tables["hhea"][0]
+        self.ascender, self.descender = struct.unpack_from(">hh", self.data, hhea + 4)
+        self.num_hmetrics, = struct.unpack_from(">H", self.data, hhea + 34)
+
+        self.fixed = 0
+        if "post" in self.tables:
+            is_fixed, = struct.unpack_from(">I", self.data, self.tables["post"][0] + 12)
+            self.fixed = 1 if is_fixed else 0
+
+        self.bold, self.italic = False, False
+        if "OS/2" in self.tables:
+            fs_selection, = struct.unpack_from(">H", self.data, self.tables["OS/2"][0] + 62)
+            self.italic = bool(fs_selection & 0x01)
+            self.bold = bool(fs_selection & 0x20)
+
+        self.family = self.read_family()
+        self.lookup = self.read_cmap()
+        self.advances = {} # char -> advance width in font units
+
+    def read_family(self):
+        """Family name from the 'name' table (nameID 1), falls back to the file name"""
+        if "name" not in self.tables:
+            return os.path.splitext(os.path.basename(self.path))[0]
+        base = self.tables["name"][0]
+        _, count, strings = struct.unpack_from(">HHH", self.data, base)
+        fallback = None
+        for i in range(count):
+            platform, encoding, _, name_id, length, offset = struct.unpack_from(">HHHHHH", self.data, base + 6 + 12 * i)
+            if name_id != 1:
+                continue
+            raw = self.data[base + strings + offset: base + strings + offset + length]
+            if platform in (0, 3):
+                return raw.decode("utf-16-be", "replace")
+            fallback = raw.decode("latin-1")
+        return fallback or os.path.splitext(os.path.basename(self.path))[0]
+
+    def read_cmap(self):
+        """Returns a function mapping a code point to a glyph index, using the best unicode subtable"""
+        base = self.tables["cmap"][0]
+        _, count = struct.unpack_from(">HH", self.data, base)
+        subtables = {}
+        for i in range(count):
+            platform, encoding, offset = struct.unpack_from(">HHI", self.data, base + 4 + 8 * i)
+            fmt, = struct.unpack_from(">H", self.data, base + offset)
+            subtables[(platform, encoding, fmt)] = base + offset
+
+        for key in [(3, 10, 12), (0, 4, 12), (0, 6, 12)]:
+            if key in subtables:
+                return self.format12(subtables[key])
+        for key in [(3, 1, 4), (0, 3, 4), (0, 1, 4), (0, 0, 4), (3, 0, 4)]:
+            if key in subtables:
+                return self.format4(subtables[key])
+        raise ValueError(f"{self.path} has no unicode cmap")
+
+    def format4(self, offset):
+        data = self.data
+        seg_count = struct.unpack_from(">H", data, offset + 6)[0] // 2
+        ends_at = offset + 14
+        starts_at = ends_at + 2 * seg_count + 2
+        deltas_at = starts_at + 2 * seg_count
+        ranges_at = deltas_at + 2 * seg_count
+        ends = struct.unpack_from(">%dH" % seg_count, data, ends_at)
+        starts = struct.unpack_from(">%dH" % seg_count, data, starts_at)
+        deltas = struct.unpack_from(">%dH" % seg_count, data, deltas_at)
+        ranges = struct.unpack_from(">%dH" % seg_count, data, ranges_at)
+
+        def lookup(cp):
+            if cp > 0xFFFF:
+                return 0
+            for i in range(seg_count):
+                if cp <= ends[i]:
+                    break
+            else:
+                return 0
+            if cp < starts[i]:
+                return 0
+            if ranges[i] == 0:
+                return (cp + deltas[i]) & 0xFFFF
+            glyph_at = ranges_at + 2 * i + ranges[i] + 2 * (cp - starts[i])
+            glyph, = struct.unpack_from(">H", data, glyph_at)
+            return (glyph + deltas[i]) & 0xFFFF if glyph else 0
+        return lookup
+
+    def format12(self, offset):
+        groups_count, = struct.unpack_from(">I", self.data, offset + 12)
+        groups = [struct.unpack_from(">III", self.data, offset + 16 + 12 * i) for i in range(groups_count)]
+
+        def lookup(cp):
+            for start, end, glyph in groups:
+                if start <= cp <= end:
+                    return glyph + cp - start
+                if cp < start:
+                    break
+            return 0
+        return lookup
+
+    def advance(self, char):
+        """Advance width of one character, in font units"""
+        if char not in self.advances:
+            glyph = min(self.lookup(ord(char)), self.num_hmetrics - 1) # glyphs past numberOfHMetrics share the last advance
+            self.advances[char], = struct.unpack_from(">H", self.data, self.tables["hmtx"][0] + 4 * glyph)
+        return self.advances[char]
+
+
+class TrueTypeFont:
+    """Drop-in for tkinter.font.Font, measuring with the tables of a FontFile"""
+    def __init__(self, font_file, size, weight, style):
+        self.file = font_file
+        self.size = size
+        self.weight = weight
+        self.slant = style
+        self.scale = size * PIXELS_PER_POINT / font_file.units_per_em
+
+        ascent = round(font_file.ascender * self.scale)
+        descent = round(-font_file.descender * self.scale)
+        self._metrics = {
+            "ascent": ascent,
+            "descent": descent,
+            "linespace": ascent + descent,
+            "fixed": font_file.fixed,
+        }
+
+    def measure(self, text):
+        advance = self.file.advance
+        return round(sum(advance(c) for c in text) * self.scale)
+
+    def metrics(self, *options):
+        if options:
+            return self._metrics[options[0]]
+        return dict(self._metrics)
+
+    def cget(self, option):
+        if option == "family":
+            return self.file.family
+        return getattr(self, option)
+
+    def __str__(self):
+        # a Tk font description, so canvas.create_text(font=...) still works when a display is available
+        return "{%s} %d %s %s" % (self.file.family, self.size, self.weight, self.slant)
+
+
+class TrueTypeFontBackend:
+    """Fonts measured from TrueType files on disk. Needs no display, so layout can run headless and in worker processes."""
+    name = "truetype"
+
+    def __init__(self, paths=None):
+        self.faces = self.find_faces(paths or font_search_path())
+        if not self.faces:
+            raise RuntimeError("No TrueType fonts found, set BROWSER_FONT_PATH to a directory with .ttf files")
+
+    def find_faces(self, paths):
+        """Returns the faces of the best family found: {(bold, italic): FontFile}"""
+        files = list(font_files(paths))
+        # only open files that look like a preferred family, unless there are none
+        prefixes = tuple(family.replace(" ", "").lower() for family in FONT_FAMILIES)
+        preferred = [path for path in files if os.path.basename(path).replace(" ", "").lower().startswith(prefixes)]
+        return self.pick_family(preferred) or self.pick_family(files)
+
+    def pick_family(self, paths):
+        families = {}
+        for path in paths:
+            try:
+                font_file = FontFile(path)
+            except (OSError, ValueError, struct.error):
+                continue
+            faces = families.setdefault(font_file.family, {})
+            faces.setdefault((font_file.bold, font_file.italic), font_file)
+
+        for family in FONT_FAMILIES: # prefer common sans-serif families, like Tk's default font
+            if family in families and (False, False) in families[family]:
+                return families[family]
+        for faces in families.values():
+            if (False, False) in faces:
+                return faces
+        return None
+
+    def create_font(self, size, weight, style):
+        bold, italic = weight == "bold", style == "italic"
+        for face in [(bold, italic), (bold, False), (False, italic), (False, False)]:
+            if face in self.faces:
+                return TrueTypeFont(self.faces[face], size, weight, style)
+
+
+def font_search_path():
+    """Directories (or files) to look for fonts in, BROWSER_FONT_PATH first"""
+    extra = os.environ.get("BROWSER_FONT_PATH", "")
+    return [path for path in extra.split(os.pathsep) if path] + FONT_DIRS
+
+
+def font_files(paths):
+    for path in paths:
+        if os.path.isfile(path):
+            yield path
+            continue
+        for dirpath, _, filenames in os.walk(path):
+            for filename in sorted(filenames):
+                if filename.lower().endswith((".ttf", ".otf", ".ttc")):
+                    yield os.path.join(dirpath, filename)
+
+
+# backend selection
+
+BACKENDS = {
+    "tk": TkFontBackend,
+    "truetype": TrueTypeFontBackend,
+}
+
+BACKEND = None
+
+
+def get_backend():
+    global BACKEND
+    if BACKEND is None:
+        BACKEND = BACKENDS[os.environ.get("BROWSER_FONT_BACKEND", FONT_BACKEND)]()
+    return BACKEND
+
+
+def set_backend(backend):
+    """Selects the font backend by name ("tk", "truetype") or instance. Call it before any layout happens."""
+    global BACKEND
+    if isinstance(backend, str):
+        backend = BACKENDS[backend]()
+    BACKEND = backend
+    return BACKEND
+
+
+# text measurement cache
+
+class MeasureCache:
+    """Memoizes font.measure() per (font key, text) under a bounded LRU, and font.metrics() once per font.
+
+    Fonts are identified by the `key` that the font registry stores on them."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.enabled = True
+        self.widths = OrderedDict() # (font key, text) -> width, least recently used first
+        self.font_metrics = {} # font key -> metrics dict
+        self.stats = {"hits": 0, "misses": 0, "metrics_hits": 0, "metrics_misses": 0, "evictions": 0}
+
+    def measure(self, font, text):
+        if not self.enabled:
+            return font.measure(text)
+        key = (font.key, text)
+        width = self.widths.get(key)
+        if width is not None:
+            self.stats["hits"] += 1
+            self.widths.move_to_end(key)
+            return width
+
+        self.stats["misses"] += 1
+        width = font.measure(text)
+        self.widths[key] = width
+        if len(self.widths) > self.capacity:
+            self.widths.popitem(last=False)
+            self.stats["evictions"] += 1
+        return width
+
+    def metrics(self, font, option=None):
+        """Like font.metrics(option); the returned dict is shared, don't modify it"""
+        if not self.enabled:
+            return font.metrics(option) if option else font.metrics()
+        font_metrics = self.font_metrics.get(font.key)
+        if font_metrics is None:
+            self.stats["metrics_misses"] += 1
+            font_metrics = self.font_metrics[font.key] = font.metrics()
+        else:
+            self.stats["metrics_hits"] += 1
+        return font_metrics[option] if option else font_metrics
+
+    def hit_rate(self):
+        lookups = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / lookups if lookups else 0.0
+
+    def clear(self):
+        self.widths.clear()
+        self.font_metrics.clear()
+        for stat in self.stats:
+            self.stats[stat] = 0
+
+
+MEASURE_CACHE = MeasureCache(MEASURE_CACHE_SIZE)
+
+
+def measure(font, text):
+    return MEASURE_CACHE.measure(font, text)
+
+
+def metrics(font, option=None):
+    return MEASURE_CACHE.metrics(font, option)
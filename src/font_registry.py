@@ -0,0 +1,75 @@
+# Font registry shared by every layout engine
+import time
+import weakref
+from collections import OrderedDict
+from font_metrics import get_backend
+from constants import FONT_REGISTRY_SIZE, MIN_FONT_SIZE, MAX_FONT_SIZE
+
+
+def quantize_size(size):
+    """Snaps a (possibly fractional) point size to the sizes fonts are created for.
+
+    Small sizes keep 1pt steps, above 24pt 2pt steps are indistinguishable enough."""
+    size = min(max(round(size), MIN_FONT_SIZE), MAX_FONT_SIZE)
+    if size > 24:
+        size = 2 * round(size / 2)
+    return size
+
+
+class FontRegistry:
+    """Creates fonts through the current font backend and keeps the most recently used ones.
+
+    Fonts evicted from the LRU stay reachable while something (a layout object, a display list)
+    still holds them, so one key never maps to two live fonts."""
+    def __init__(self, capacity):
+        self.capacity = capacity
+        self.fonts = OrderedDict() # key -> font, least recently used first
+        self.live = weakref.WeakValueDictionary() # key -> every font still referenced somewhere
+        self.stats = {"hits": 0, "revived": 0, "created": 0, "evictions": 0, "creation_time": 0.0}
+
+    def get(self, size, weight, style):
+        backend = get_backend() # Tk, or TrueType files when running headless
+        size = quantize_size(size)
+        key = (backend.name, size, weight, style)
+
+        font = self.fonts.get(key)
+        if font is not None:
+            self.stats["hits"] += 1
+            self.fonts.move_to_end(key)
+            return font
+
+        font = self.live.get(key)
+        if font is not None:
+            self.stats["revived"] += 1
+        else:
+            start = time.perf_counter()
+            font = backend.create_font(size, weight, style)
+            self.stats["creation_time"] += time.perf_counter() - start
+            self.stats["created"] += 1
+            font.key = key # identifies the font in the measurement cache
+            self.live[key] = font
+
+        self.fonts[key] = font
+        if len(self.fonts) > self.capacity:
+            self.fonts.popitem(last=False)
+            self.stats["evictions"] += 1
+        return font
+
+    def live_count(self):
+        return len(self.live)
+
+    def report(self):
+        created = self.stats["created"]
+        return dict(
+            self.stats,
+            cached=len(self.fonts),
+            live=self.live_count(),
+            avg_creation_time=self.stats["creation_time"] / created if created else 0.0,
+        )
+
+
+FONT_REGISTRY = FontRegistry(FONT_REGISTRY_SIZE)
+
+
+def get_font(size, weight, style):
+    return FONT_REGISTRY.get(size, weight, style)
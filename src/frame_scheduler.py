@@ -0,0 +1,65 @@
+# Frame scheduler: input handlers only change state and ask for a frame, frames are drawn from Tk's event loop
+import time
+from collections import deque
+from math import ceil
+from constants import FRAME_RATE, FRAME_TIMES_KEPT
+
+
+class FrameScheduler:
+    """Calls `frame` (which draws everything that changed) at most once per frame interval.
+
+    A request more than an interval after the last frame is drawn right away, so sparse input
+    isn't delayed. A request within the interval waits for its slot with after(), then for the
+    events Tk has queued by then with after_idle(); the requests made meanwhile coalesce into it.
+    Waiting for the slot costs up to an interval of latency (see `benchmark.py frames`), what it
+    buys is a bounded amount of drawing when input comes faster than frames can be drawn."""
+    def __init__(self, window, frame, rate=FRAME_RATE):
+        self.window = window
+        self.frame = frame
+        self.interval = 1 / rate # seconds
+        self.scheduled = False
+        self.running = False # inside frame()
+        self.requested = None # first request since the last frame
+        self.last = None # start of the last frame
+        self.times = deque(maxlen=FRAME_TIMES_KEPT) # how long the latest frames took, in seconds
+        self.stats = {"frames": 0, "requests": 0, "coalesced": 0, "dropped": 0}
+
+    def request(self):
+        self.stats["requests"] += 1
+        if self.scheduled:
+            self.stats["coalesced"] += 1
+            return
+        self.requested = time.perf_counter()
+        wait = 0 if self.last is None else self.last + self.interval - self.requested
+        if wait <= 0 and not self.running:
+            self.run() # due: drawn right away
+            return
+        self.scheduled = True
+        if wait > 0:
+            self.window.after(ceil(wait * 1000), self.when_idle)
+        else:
+            self.window.after_idle(self.run) # asked for by the frame itself
+
+    def when_idle(self):
+        self.window.after_idle(self.run)
+
+    def run(self):
+        start = time.perf_counter()
+        self.scheduled = False # the frame itself may ask for the next one
+        # frame slots that went by between when this frame was due and when it could run
+        due = self.requested if self.last is None else max(self.requested, self.last + self.interval)
+        self.stats["dropped"] += int((start - due) / self.interval)
+        self.last = start
+        self.running = True
+        try:
+            self.frame()
+        finally:
+            self.running = False
+        elapsed = time.perf_counter() - start
+        self.stats["dropped"] += int(elapsed / self.interval) # and the slots it ran into, e.g. laying out more of the page
+        self.times.append(elapsed)
+        self.stats["frames"] += 1
+
+    def average(self):
+        """Average duration of the latest frames, in seconds"""
+        return sum(self.times) / len(self.times) if self.times else 0.0
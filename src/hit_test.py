@@ -0,0 +1,34 @@
+# Hit testing: the layout object under a point, found by descending only through the boxes that contain it
+from array import array
+from bisect import bisect_right
+
+
+def contains(obj, x, y):
+    return obj.x <= x < obj.x + obj.width and obj.y <= y < obj.y + obj.height
+
+
+class HitTestIndex:
+    """Finds the deepest layout object at a point of a laid out document.
+
+    The children of a layout object (blocks, or the lines of a block) are stacked top to bottom, so
+    the only one that can contain a point is found by bisecting their ys, and a line finds its word
+    from its xs (LineLayout.node_at). An object's ys are collected the first time a hit test goes
+    through it; the index is only valid for the layout it was made after."""
+    def __init__(self, document):
+        self.document = document
+        self.ys = {} # id(layout object) -> y of each of its children
+
+    def hit(self, x, y):
+        """The deepest layout object whose box contains (x, y) (the last one painted there), or None"""
+        obj = self.document
+        if obj.height is None or not contains(obj, x, y):
+            return None
+        while obj.children:
+            ys = self.ys.get(id(obj))
+            if ys is None:
+                ys = self.ys[id(obj)] = array("d", [child.y for child in obj.children])
+            i = bisect_right(ys, y) - 1 # the last child starting above the point
+            if i < 0 or not contains(obj.children[i], x, y):
+                break
+            obj = obj.children[i]
+        return obj
@@ -1,21 +1,8 @@
 # Layout and font management
-import tkinter
-import tkinter.font
+from font_registry import get_font
 from constants import WIDTH, HEIGHT, HSTEP, VSTEP
 from lexer import Text, Tag
 
-FONTS = {}
-
-# font management system
-def get_font(size, weight, style):
-    key = (size, weight, style)
-    if key not in FONTS:
-        font = tkinter.font.Font(size=size, weight=weight,
-            slant=style)
-        label = tkinter.Label(font=font)
-        FONTS[key] = (font, label)
-    return FONTS[key][0]
-
 
 class Layout:
     def __init__(self, tokens):
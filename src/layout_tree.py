@@ -1,9 +1,14 @@
 # Layout and font management
-import tkinter
-import tkinter.font
-from constants import WIDTH, HEIGHT, HSTEP, VSTEP, BLOCK_ELEMENTS
+from array import array
+from bisect import bisect_right
+from itertools import accumulate
+from math import ceil
+from font_metrics import measure, metrics
+from font_registry import get_font
+from constants import WIDTH, HEIGHT, HSTEP, VSTEP, BLOCK_ELEMENTS, LINE_BREAK_MIN_RUN
+from constants import ESTIMATED_CHAR_WIDTH, ESTIMATED_LINE_HEIGHT
 from parser import Text, Element
-from utils import parse_font_size
+from traversal import walk, preorder
 
 class Rect:
     def __init__(self, left, top, right, bottom):
@@ -15,65 +20,121 @@ class Rect:
     def contains_point(self, x, y):
         return (x >= self.left and x < self.right and y >= self.top and y < self.bottom)
 
-FONTS = {}
-
-# font management system
-def get_font(size, weight, style):
-    key = (size, weight, style)
-    if key not in FONTS:
-        font = tkinter.font.Font(size=size, weight=weight,
-            slant=style)
-        label = tkinter.Label(font=font)
-        FONTS[key] = (font, label)
-    return FONTS[key][0]
+    def contains(self, rect):
+        return (rect.left >= self.left and rect.right <= self.right and rect.top >= self.top and rect.bottom <= self.bottom)
 
 
 class DocumentLayout:
-    def __init__(self, node):
+    def __init__(self, node, viewport_width=WIDTH):
         self.node = node
         self.parent = None
         self.children = []
+        self.viewport_width = viewport_width
 
         self.x = None
         self.y = None
         self.width = None
         self.height = None 
 
-    def layout(self):
-        child = BlockLayout(self.node, self, None)
-        self.children.append(child)
+        self.until = None # y the last layout() was asked to reach, None for all of it
+        self.complete = False # no block was left with an estimated height
+
+    def layout(self, until=None, prepared=None):
+        """Lays out the document, reusing what didn't change since the last call.
+
+        With `until`, blocks starting below that y are only given an estimated height (their real
+        layout waits for a later call with a larger `until`), so a long page costs about as much
+        as what's on screen.
+
+        Returns counters: layout objects laid out (again), objects only moved to a new y, blocks
+        kept exactly as they were (their contents not counted), blocks whose already measured
+        words were only broken into lines again (after a width change) and estimated blocks.
+
+        `prepared` maps id(node) to subtrees laid out elsewhere (see parallel_layout.py)."""
+        if not self.children:
+            self.children.append(BlockLayout(self.node, self, None))
+        child = self.children[0]
 
-        self.width = WIDTH - 2 * HSTEP
+        self.width = self.viewport_width - 2 * HSTEP
         self.x = HSTEP
         self.y = VSTEP 
 
-        child.layout() # recursive call to layout
+        stats = new_layout_stats()
+        child.layout(stats, until, prepared) # lays out the whole tree below it
 
         self.height = child.height
+        self.until = until
+        self.complete = stats["estimated"] == 0
+        return stats
+
+    def covers(self, bottom):
+        """Whether everything above `bottom` has its real layout"""
+        return self.complete or (self.until is not None and bottom <= self.until)
+
+    def anchor_at(self, y):
+        """(node, offset): the innermost laid out block at `y`, and how far `y` is into it.
+
+        Its node finds the block again after a layout, see anchor_y()."""
+        anchor, obj = None, self
+        while True:
+            for child in obj.children:
+                if isinstance(child, BlockLayout) and not child.estimated and child.y + child.height > y:
+                    anchor = obj = child
+                    break
+            else:
+                break
+        if anchor is None:
+            return None
+        return anchor.node, y - anchor.y
+
+    def anchor_y(self, anchor):
+        """Where the point saved by anchor_at() is now, or None if its block is gone.
+
+        If the block (moved out of reach) is inside an estimated block, it's only where that one
+        starts: laying out down from there finds the real position."""
+        node, offset = anchor
+        path = []
+        while node is not None:
+            path.append(node)
+            node = node.parent
+        obj = self
+        for node in reversed(path): # from the root down, through the blocks of the node's ancestors
+            obj = next((child for child in obj.children if isinstance(child, BlockLayout) and child.node is node), None)
+            if obj is None:
+                return None
+            if obj.estimated:
+                break
+        return obj.y + offset
+
+    def resize(self, viewport_width):
+        """Takes a new window width; the next layout() reflows what depends on it"""
+        self.viewport_width = viewport_width
 
     def paint(self):
         return []
     
 class DrawText:
-    def __init__(self, x1, y1, text, font, color):
+    def __init__(self, x1, y1, text, font, color, width=None, height=None):
+        # width and height (of the text and of a line in its font) when layout already knows them
         self.rect = Rect(
             x1, 
             y1,
-            x1 + font.measure(text), 
-            y1 + font.metrics("linespace")
+            x1 + (measure(font, text) if width is None else width), 
+            y1 + (metrics(font, "linespace") if height is None else height)
         )
         self.text = text
         self.font = font
         self.color = color
 
-    def execute(self, scroll, canvas):
-        canvas.create_text(
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_text(
             self.rect.left, 
             self.rect.top - scroll,
             text=self.text,
             font=self.font,
             anchor='nw',
-            fill=self.color
+            fill=self.color,
+            tags=tags
         )
 
 class DrawRect:
@@ -81,23 +142,141 @@ class DrawRect:
         self.rect = rect
         self.color = color
 
-    def execute(self, scroll, canvas):
-        canvas.create_rectangle(
+    def execute(self, scroll, canvas, tags=()):
+        return canvas.create_rectangle(
             self.rect.left, 
             self.rect.top - scroll,
             self.rect.right, 
             self.rect.bottom - scroll,
             width=0,
-            fill=self.color
+            fill=self.color,
+            tags=tags
         )
 
 
+class FontTable:
+    """Small integer ids for fonts, with the width of their space and their metrics.
+
+    Only the fonts' keys are kept, not the fonts: those stay the font registry's to evict, and
+    font() gets them back from it."""
+    def __init__(self):
+        self.keys = [] # font.key of each id
+        self.spaces = []
+        self.metrics = []
+        self.ids = {} # font.key -> id
+
+    def id(self, font):
+        font_id = self.ids.get(font.key)
+        if font_id is None:
+            font_id = self.ids[font.key] = len(self.keys)
+            self.keys.append(font.key)
+            self.spaces.append(measure(font, " "))
+            self.metrics.append(metrics(font))
+        return font_id
+
+    def font(self, font_id):
+        _, size, weight, style = self.keys[font_id]
+        return get_font(size, weight, style)
+
+
+# shared by every layout; one id per font key, and keys are bounded by the registry's quantized sizes
+FONTS = FontTable()
+
+
+class InlineContent:
+    """The measured inline content of a block, kept to break it into lines again (e.g. at another width).
+
+    Instead of an object per word, words are parallel arrays: offsets into one string holding all the
+    block's text, measured width, font id (in FONTS) and node id. Tags are (index of the next word,
+    "open"/"close", tag, attributes)."""
+    def __init__(self):
+        self.text = ""
+        self.words = [] # until finish() joins them into `text`
+        self.length = 0
+        self.starts = array("l")
+        self.ends = array("l")
+        self.widths = array("l")
+        self.font_ids = array("l")
+        self.node_ids = array("l")
+        self.nodes = [] # Text nodes, by id
+        self.tags = []
+
+        self.positions = None # see one_line()
+
+    def add_text(self, node, font):
+        """Measures the words of a Text node, all in the same font"""
+        words = node.text.split()
+        if not words:
+            return
+        self.words.extend(words)
+        for word in words:
+            self.starts.append(self.length)
+            self.length += len(word) + 1 # joined with a space
+        self.ends.extend([start + len(word) for start, word in zip(self.starts[-len(words):], words)])
+        self.widths.extend([measure(font, word) for word in words])
+        self.font_ids.extend([FONTS.id(font)] * len(words))
+        self.node_ids.extend([len(self.nodes)] * len(words))
+        self.nodes.append(node)
+
+    def add_tag(self, kind, tag, attributes=None):
+        self.tags.append((len(self.starts), kind, tag, attributes))
+
+    def finish(self):
+        self.text = " ".join(self.words)
+        self.words = None
+
+    def word(self, index):
+        return self.text[self.starts[index]:self.ends[index]]
+
+    # batched line breaking, for runs of words with no tags in between
+
+    def one_line(self):
+        """(lefts, rights): where every word would start and end if they were all on one line.
+        lefts has one more entry, where a word after the last one would start."""
+        if self.positions is None:
+            spaces = FONTS.spaces
+            steps = [width + spaces[font_id] for width, font_id in zip(self.widths, self.font_ids)]
+            lefts = array("l", accumulate(steps, initial=0))
+            rights = array("l", [left + width for left, width in zip(lefts, self.widths)])
+            self.positions = (lefts, rights)
+        return self.positions
+
+    def fitting(self, start, room):
+        """Index after the last word (from `start` on) ending within `room` of where word `start` begins"""
+        lefts, rights = self.one_line()
+        return bisect_right(rights, lefts[start] + room)
+
+    def node(self, index):
+        return self.nodes[self.node_ids[index]]
+
+
 class LineLayout:
+    """A line of words, stored as parallel arrays instead of an object per word: index of the word in
+    the block's InlineContent, x offset from the line's x, width, font id and superscript flag"""
     def __init__(self, node, parent, previous):
         self.node = node
         self.parent = parent
         self.previous = previous
-        self.children = []
+        self.children = [] # words aren't layout objects
+
+        self.words = array("l")
+        self.xs = array("l")
+        self.widths = array("l")
+        self.font_ids = array("l")
+        self.supers = array("b")
+
+    def add_word(self, word, font_id, width, superscript):
+        self.words.append(word)
+        self.widths.append(width)
+        self.font_ids.append(font_id)
+        self.supers.append(superscript)
+
+    def add_run(self, content, start, stop):
+        """Adds words start..stop-1 of the block's content, as measured (not superscript)"""
+        self.words.extend(range(start, stop))
+        self.widths.extend(content.widths[start:stop])
+        self.font_ids.extend(content.font_ids[start:stop])
+        self.supers.frombytes(bytes(stop - start))
 
     def layout(self):
         self.width = self.parent.width
@@ -108,132 +287,93 @@ class LineLayout:
         else:
             self.y = self.parent.y
 
-        # First, layout all the words to get their dimensions
-        for word in self.children:
-            word.layout()
-        
         # If no words in this line, set minimal height and return
-        if not self.children:
+        count = len(self.words)
+        if not count:
             self.height = VSTEP
             return
-        
-        # Separate metrics calculations for normal and superscript text
-        normal_metrics = []
-        super_metrics = []
-        
-        for word in self.children:
-            metrics = word.font.metrics()
-            if hasattr(word, 'is_superscript') and word.is_superscript:
-                super_metrics.append(metrics)
-            else:
-                normal_metrics.append(metrics)
-        
-        # Calculate baseline based on normal text (if any)
-        if normal_metrics:
-            max_normal_ascent = max([metric["ascent"] for metric in normal_metrics])
-            baseline_offset = 1.25 * max_normal_ascent
-        else:
-            # If only superscript text on this line, use superscript metrics
-            max_super_ascent = max([metric["ascent"] for metric in super_metrics]) if super_metrics else 0
-            baseline_offset = 1.25 * max_super_ascent
-        
-        # Set baseline relative to line's y position
-        baseline = self.y + baseline_offset
-        
-        # Handle center alignment
-        if self.align == "center":
-            # Calculate total width of all words plus spaces between them
-            total_content_width = 0
-            for i, word in enumerate(self.children):
-                total_content_width += word.width
-                if i < len(self.children) - 1:  # Add space width except for last word
-                    total_content_width += word.font.measure(" ")
-            
-            # Calculate starting x position to center the content
-            available_width = self.width
-            center_start_x = self.x + (available_width - total_content_width) // 2
-            
-            # Reposition all words for centering
-            current_x = center_start_x
-            for word in self.children:
-                word.x = current_x
-                current_x += word.width + word.font.measure(" ")
-        
-        # Position each word vertically based on baseline
-        for word in self.children:
-            is_super = hasattr(word, 'is_superscript') and word.is_superscript
-            word.y = self._calculate_word_y(baseline, word.font, is_super, normal_metrics)
-        
-        # Calculate line height
-        all_metrics = normal_metrics + super_metrics
-        if all_metrics:
-            max_descent = max([metric["descent"] for metric in all_metrics])
-            self.height = int(baseline_offset + 1.25 * max_descent)
-        else:
-            self.height = VSTEP
-
-    def _calculate_word_y(self, baseline, font, is_super, normal_metrics):
-        """Calculate y position for a word, handling superscript positioning"""
-        if is_super and normal_metrics:
-            # Superscript: align top of superscript with top of normal letters
-            normal_ascent = max([metric["ascent"] for metric in normal_metrics])
-            super_ascent = font.metrics()["ascent"]
-            
-            # Position so superscript top aligns with normal text top
-            normal_top = baseline - normal_ascent
-            super_baseline = normal_top + super_ascent
-            return int(super_baseline - super_ascent)
-        else:
-            # Normal text positioning
-            return int(baseline - font.metrics()["ascent"])
-
-    def paint(self):
-        return []
-    
 
+        spaces = FONTS.spaces
+        widths, font_ids = self.widths, self.font_ids
 
-class TextLayout:
-    def __init__(self, node, word, parent, previous):
-        self.node = node
-        self.word = word
-        self.parent = parent
-        self.previous = previous
-        self.children = []
+        # x offsets: each word starts one space (in its font) after the previous one
+        xs = array("l", [0]) * count
+        x = 0
+        for i in range(count):
+            xs[i] = x
+            x += widths[i] + spaces[font_ids[i]]
 
-        self.is_superscript = getattr(parent.parent, "superscript", False)
+        # Handle center alignment
+        if self.align == "center":
+            # total width of all words plus spaces between them
+            total_content_width = x - spaces[font_ids[-1]]
+            offset = (self.width - total_content_width) // 2
+            for i in range(count):
+                xs[i] += offset
+        self.xs = xs
 
-    def layout(self):
-        weight = self.node.style["font-weight"]
-        style = self.node.style["font-style"]
-        if style == "normal": 
-            style = "roman"
-        
-        # Get base size and apply superscript scaling if needed
-        font_size_px = parse_font_size(self.node.style["font-size"])
-        base_size = int(font_size_px * 0.75)
+        # Separate metrics calculations for normal and superscript text
+        normal_ascent = super_ascent = descent = None
+        font_metrics = FONTS.metrics
+        for font_id, superscript in set(zip(font_ids, self.supers)):
+            metric = font_metrics[font_id]
+            if superscript:
+                super_ascent = metric["ascent"] if super_ascent is None else max(super_ascent, metric["ascent"])
+            else:
+                normal_ascent = metric["ascent"] if normal_ascent is None else max(normal_ascent, metric["ascent"])
+            descent = metric["descent"] if descent is None else max(descent, metric["descent"])
 
-        if self.is_superscript:
-            size = max(8, int(base_size * 0.6))  # 60% of normal size, minimum 8px
-        else:
-            size = base_size
-            
-        self.font = get_font(size, weight, style)
+        # Calculate baseline based on normal text (if any), otherwise on the superscript text
+        baseline_offset = 1.25 * (normal_ascent if normal_ascent is not None else super_ascent)
 
-        self.width = self.font.measure(self.word)
+        # Calculate line height
+        self.height = int(baseline_offset + 1.25 * descent)
 
-        # Set initial x position (will be adjusted for centering in LineLayout)
-        if self.previous:
-            space = self.previous.font.measure(" ")
-            self.x = self.previous.x + space + self.previous.width
-        else:
-            self.x = self.parent.x
+    def node_at(self, x):
+        """The Text node of the word at `x`, or None between words"""
+        offset = x - self.x
+        i = bisect_right(self.xs, offset) - 1
+        if i >= 0 and offset < self.xs[i] + self.widths[i]:
+            return self.parent.inline.node(self.words[i])
+        return None
 
-        self.height = self.font.metrics("linespace")
-        
     def paint(self):
-        color = self.node.style["color"]
-        return [DrawText(self.x, self.parent.y, self.word, self.font, color)]
-    
+        """A DrawText per word, sized from the widths measured by layout (see display_list.compact())"""
+        content = self.parent.inline
+        font_metrics = FONTS.metrics
+        fonts = {font_id: FONTS.font(font_id) for font_id in set(self.font_ids)}
+        cmnds = []
+        for i in range(len(self.words)):
+            word, font_id = self.words[i], self.font_ids[i]
+            color = content.node(word).style.color
+            cmnds.append(DrawText(self.x + self.xs[i], self.y, content.word(word), fonts[font_id], color,
+                                  self.widths[i], font_metrics[font_id]["linespace"]))
+        return cmnds
+
+
+def new_layout_stats():
+    return {"laid_out": 0, "shifted": 0, "reused": 0, "reflowed": 0, "estimated": 0}
+
+
+def layout_mode(node):
+    """Determine which way to lay out text, inline/blocks"""
+    if isinstance(node, Text):
+        return "inline"
+    elif any([isinstance(child, Element) and child.tag in BLOCK_ELEMENTS for child in node.children]):
+        return "block"
+    elif node.children:
+        return "inline"
+    else:
+        return "block"
+
+
+def layout_children(obj):
+    """Children visited by BlockLayout.layout(): blocks and lines of blocks being laid out; words are
+    handled by their line, the subtree of a reused block is already up to date and an estimated
+    block has no children yet"""
+    if isinstance(obj, BlockLayout) and not obj.reused and not obj.estimated:
+        return obj.children
+    return ()
 
 
 class BlockLayout:
@@ -248,6 +388,11 @@ class BlockLayout:
         self.y = None
         self.width = None
         self.height = None
+        self.reused = False # set by the last layout() when nothing inside this block had to change (or a worker laid it out)
+        self.inline = None # inline mode: the InlineContent, kept for reflowing at another width
+        self.estimated = False # below what the last layout() had to reach: no children, a guessed height
+        self.pending = False # some block inside is estimated
+        self.siblings = (0, 0) # estimated: total height and count of the laid out siblings before it
 
         # self.display_list = []
 
@@ -262,29 +407,88 @@ class BlockLayout:
             previous = next
 
     def layout_mode(self):
-        """Determine which way to lay out text, inline/blocks"""
-        if isinstance(self.node, Text):
-            return "inline"
-        elif any([isinstance(child, Element) and child.tag in BLOCK_ELEMENTS for child in self.node.children]):
-            return "block"
-        elif self.node.children:
-            return "inline"
-        else:
-            return "block"
-        
-    def layout(self):
-
-        # computing size and position of each BlockLayout separately
-
-        # x position must be computed before the recursive layout call of childrens
-        self.x = self.parent.x
-        self.width = self.parent.width
+        return layout_mode(self.node)
+
+    def layout(self, stats=None, until=None, prepared=None):
+        """Lays out this block and everything below it, without recursion:
+        positions and children on the way down, heights on the way up.
+
+        Blocks whose node (and everything inside) is clean and whose width is unchanged keep their
+        layout objects, and are just moved when a previous sibling changed height. Blocks starting
+        below `until` that would need any layout work are estimated instead."""
+        if stats is None:
+            stats = new_layout_stats()
+        for obj, entering in walk(self, layout_children):
+            if isinstance(obj, LineLayout):
+                if entering:
+                    obj.layout() # a line lays out its own words
+                    stats["laid_out"] += 1
+            elif entering:
+                obj.layout_position(stats, until, prepared)
+            elif not obj.reused and not obj.estimated:
+                obj.height = sum([child.height for child in obj.children])
+                obj.pending = any(isinstance(child, BlockLayout) and (child.estimated or child.pending) for child in obj.children)
+        return stats
+
+    def layout_position(self, stats, until=None, prepared=None):
+        # x position must be computed before the children are laid out
+        width = self.parent.width
+        x = self.parent.x
         if self.previous: # if there is a previous sibling, then start right after it
-            self.y = self.previous.y + self.previous.height
+            y = self.previous.y + self.previous.height
         else: # otherwise, start at its parent's top edge
-            self.y = self.parent.y
+            y = self.parent.y
+
+        node = self.node
+        below = until is not None and y >= until
+        clean = self.height is not None and not node.layout_dirty
+        same_box = width == self.width and x == self.x
+        if clean and same_box and not node.layout_child_dirty:
+            if self.estimated:
+                if below: # still out of reach: the same guess, moved if needed
+                    self.y = y
+                    stats["estimated"] += 1
+                    return
+            elif not self.pending:
+                self.reused = True # nothing inside changed: keep the whole subtree, moved if needed
+                if y != self.y:
+                    stats["shifted"] += self.shift(y - self.y)
+                else:
+                    stats["reused"] += 1
+                return
+
+        # out of reach, estimated unless it's laid out blocks that can just be kept (and moved)
+        if below and not (clean and same_box and not self.estimated and self.layout_mode() == "block"):
+            self.estimate(x, y, width)
+            stats["estimated"] += 1
+            return
+
+        self.reused = False
+        if clean and not self.estimated:
+            if self.layout_mode() == "block":
+                # some child block changed, or the width: keep the children, each of them decides for itself
+                self.x, self.y, self.width = x, y, width
+                node.layout_child_dirty = False
+                stats["laid_out"] += 1
+                return
+            if not node.layout_child_dirty:
+                # same content at another width: break the already measured words into lines again
+                self.x, self.y, self.width = x, y, width
+                self.children = []
+                self.flow(self.inline)
+                stats["reflowed"] += 1
+                return
+
+        self.estimated = False
+        self.x, self.y, self.width = x, y, width
+        subtree = prepared.pop(id(node), None) if prepared else None
+        if subtree is not None and subtree.install(self, stats):
+            return # laid out by a worker process
+
+        node.layout_dirty = node.layout_child_dirty = False
+        self.children = []
+        stats["laid_out"] += 1
 
-        
         mode = self.layout_mode()
 
         if mode == "block":
@@ -294,48 +498,127 @@ class BlockLayout:
                 self.children.append(next)
                 previous = next
         else: # mode == "inline"
-            self.cursor_x = 0 # not HSTEP/VSTEP, since we are not relative to the block's x, y
-            self.cursor_y = 0
-            self.weight = "normal"
-            self.style = "roman"
-            self.size = 12
-
-            # alignment tracking
-            self.align = "left" # can be "left", "center", or "right"
-            self.in_title_h1 = False # track if we are inside <h1 class="title">
+            self.inline = self.recurse(self.node)
+            self.flow(self.inline)
 
-            # superscript tracking
-            self.superscript = False # track if we are inside <sup> superscript mode
 
-            # Process the tree recursively
+    def recurse(self, node):
+        """Flattens the inline content: opening and closing tags of Elements, measured words of Text nodes"""
+        content = InlineContent()
+        for node, entering in walk(node):
+            node.layout_dirty = node.layout_child_dirty = False # laid out with this block
+            if isinstance(node, Text):
+                if entering:
+                    content.add_text(node, self.font(node))
+            elif entering:
+                content.add_tag("open", node.tag, node.attributes)
+            else:
+                content.add_tag("close", node.tag)
+        content.finish()
+        return content
+
+    def flow(self, content):
+        """Breaks the inline content into lines of the current width"""
+        self.cursor_x = 0 # not HSTEP/VSTEP, since we are not relative to the block's x, y
+        self.cursor_y = 0
+
+        # alignment tracking
+        self.align = "left" # can be "left", "center", or "right"
+        self.in_title_h1 = False # track if we are inside <h1 class="title">
+
+        # superscript tracking
+        self.superscript = False # track if we are inside <sup> superscript mode
+
+        self.newline()
+        start = 0
+        for index, kind, tag, attributes in content.tags:
+            self.place_words(content, start, index) # the words before this tag
+            start = index
+            if kind == "open":
+                self.open_tag(tag, attributes)
+            else:
+                self.close_tag(tag)
+        self.place_words(content, start, len(content.widths))
+
+    def place_words(self, content, start, stop):
+        """Places words start..stop-1, which all come from the same Text node"""
+        if stop - start >= LINE_BREAK_MIN_RUN and not self.superscript:
+            self.place_run(content, start, stop)
+        else: # short runs, and superscript words with their own fonts
+            for i in range(start, stop):
+                self.place_word(content, i)
+
+    def place_run(self, content, start, stop):
+        """Same lines as place_word() word by word, but a whole line at a time: where a line ends
+        is a binary search over the prefix sums of the word widths"""
+        lefts = content.one_line()[0]
+
+        # the words that still fit on the current line
+        i = max(min(content.fitting(start, self.width - self.cursor_x), stop), start)
+        if i > start:
+            self.children[-1].add_run(content, start, i)
+        line_start = None
+        while i < stop:
+            # word i doesn't fit: it starts a new line (even if it's wider than the line), followed by what fits
             self.newline()
-            self.recurse(self.node)
+            end = min(max(content.fitting(i, self.width), i + 1), stop)
+            self.children[-1].add_run(content, i, end)
+            line_start, i = i, end
 
-        
-        for child in self.children:
-            child.layout()
-
-        self.height = sum([child.height for child in self.children])
-        
+        if line_start is None:
+            self.cursor_x += lefts[stop] - lefts[start]
+        else:
+            self.cursor_x = lefts[stop] - lefts[line_start]
 
 
-    def recurse(self, node):
-        """Recursively process the tree structure"""
-        if isinstance(node, Text):
-            # Process text node
-            for word in node.text.split():
-                self.word(node, word)
-        elif isinstance(node, Element):
-            # Process element node - opening tag
-            self.open_tag(node.tag, node.attributes)
-            
-            # Process all children
-            for child in node.children:
-                self.recurse(child)
-            
-            # Process closing tag
-            self.close_tag(node.tag)
-
+    def estimate(self, x, y, width):
+        """Stands in for the real layout of a block out of reach: no children, and the average
+        height of its laid out previous siblings (usually the same kind of block)"""
+        self.x, self.y, self.width = x, y, width
+        self.children = []
+        self.inline = None
+        self.reused = False
+        self.estimated = True
+
+        # sums over the laid out siblings before, continuing from the last estimated one
+        total = count = 0
+        sibling = self.previous
+        while sibling is not None:
+            if sibling.estimated:
+                total, count = total + sibling.siblings[0], count + sibling.siblings[1]
+                break
+            total, count = total + sibling.height, count + 1
+            sibling = sibling.previous
+        self.siblings = (total, count)
+        self.height = round(total / count) if count else self.text_height(width)
+
+    def text_height(self, width):
+        """A guess from the amount of text in each block inside this one, and its paragraphs (spaced
+        by VSTEP), for when there's no laid out sibling to compare with"""
+        per_line = max(width, 1) / ESTIMATED_CHAR_WIDTH
+        lines = paragraphs = 0
+        chars = [0] # text of each open block, after text outside of any (e.g. this block is a Text)
+        for node, entering in walk(self.node):
+            if isinstance(node, Text):
+                if entering:
+                    words = node.text.split() # whitespace collapses, like in recurse()
+                    chars[-1] += sum(map(len, words)) + len(words)
+            elif node.tag in BLOCK_ELEMENTS:
+                if entering:
+                    chars.append(0)
+                else:
+                    lines += ceil(chars.pop() / per_line) # a block with text starts new lines
+                    paragraphs += node.tag == "p"
+        lines += ceil(chars[0] / per_line)
+        return lines * ESTIMATED_LINE_HEIGHT + paragraphs * VSTEP
+
+    def shift(self, dy):
+        """Moves this block and everything inside it down by `dy`; returns how many objects moved"""
+        count = 0
+        for obj in preorder(self):
+            obj.y += dy
+            count += 1
+        return count
 
     def open_tag(self, tag, attributes):
         """Handle opening HTML tags"""
@@ -364,28 +647,26 @@ class BlockLayout:
             self.newline()
             self.cursor_y += VSTEP
 
-    def word(self, node, word):
-        weight = node.style["font-weight"]
-        style = node.style["font-style"]
-        if style == "normal":
-            style = "roman"
+    def font(self, node, superscript=False):
+        computed = node.style # sizes, weight and slant are already resolved by the cascade
+        size = int(computed.font_size * 0.75)
+        if superscript:
+            size = max(8, int(size * 0.6))  # 60% of normal size, minimum 8px
+        return get_font(size, computed.weight, computed.slant)
 
-        font_size_px = parse_font_size(node.style["font-size"])
-        curr_size = int(font_size_px * 0.75)
-
-        # Use the original size for width calculation (superscript scaling handled in TextLayout)
-        font = get_font(curr_size, weight, style)
-        
-        w = font.measure(word)
+    def place_word(self, content, i):
+        # line breaking uses the normal size, even for superscript words
+        w = content.widths[i]
         if self.cursor_x + w > self.width:
             self.newline()
 
-        line = self.children[-1] # get the current line
-        previous_word = line.children[-1] if line.children else None
-        text = TextLayout(node, word, line, previous_word)
-        line.children.append(text)
+        font_id, width = content.font_ids[i], w
+        if self.superscript:
+            font = self.font(content.node(i), superscript=True)
+            font_id, width = FONTS.id(font), measure(font, content.word(i))
+        self.children[-1].add_word(i, font_id, width, self.superscript) # to the current line
 
-        self.cursor_x += w + font.measure(" ")
+        self.cursor_x += w + FONTS.spaces[content.font_ids[i]]
 
 
     def newline(self):
@@ -401,7 +682,7 @@ class BlockLayout:
         if is_super and normal_metrics:
             # Superscript: align top of superscript with top of normal letters
             normal_ascent = max([metric["ascent"] for metric in normal_metrics])
-            super_ascent = font.metrics()["ascent"]
+            super_ascent = metrics(font, "ascent")
             
             # Position so superscript top aligns with normal text top
             normal_top = baseline - normal_ascent
@@ -409,16 +690,20 @@ class BlockLayout:
             return super_baseline - super_ascent
         else:
             # Normal text positioning
-            return baseline - font.metrics()["ascent"]
+            return baseline - metrics(font, "ascent")
         
 
     def paint(self):
         cmnds = [] # commands can be Text, Rectangle...
+        if self.estimated:
+            return cmnds # nothing is drawn before the real layout
 
         # background has to be before Text (always)
-        bgcolor = self.node.style.get("background-color", "transparent")
+        bgcolor = None
+        if isinstance(self.node, Element): # Text nodes share their parent's style, the parent already paints its background
+            bgcolor = self.node.style.background_color # None if transparent
 
-        if bgcolor != "transparent":
+        if bgcolor:
             x2, y2 = self.x + self.width, self.y + self.height
             rect = DrawRect(Rect(self.x, self.y, x2, y2), bgcolor)
             cmnds.append(rect)
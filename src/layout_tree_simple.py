@@ -1,20 +1,8 @@
 # Layout and font management
-import tkinter
-import tkinter.font
+from font_registry import get_font
 from constants import WIDTH, HEIGHT, HSTEP, VSTEP
 from parser import Text, Element
-
-FONTS = {}
-
-# font management system
-def get_font(size, weight, style):
-    key = (size, weight, style)
-    if key not in FONTS:
-        font = tkinter.font.Font(size=size, weight=weight,
-            slant=style)
-        label = tkinter.Label(font=font)
-        FONTS[key] = (font, label)
-    return FONTS[key][0]
+from traversal import walk
 
 
 class Layout:
@@ -35,27 +23,22 @@ class Layout:
         # superscript tracking
         self.superscript = False # track if we are inside <sup> superscript mode
 
-        # Process the tree recursively
+        # Process the tree
         self.recurse(tree)
         self.flush()
 
         
     def recurse(self, tree):
-        """Recursively process the tree structure"""
-        if isinstance(tree, Text):
-            # Process text node
-            for word in tree.text.split():
-                self.word(word)
-        elif isinstance(tree, Element):
-            # Process element node - opening tag
-            self.open_tag(tree.tag, tree.attributes)
-            
-            # Process all children
-            for child in tree.children:
-                self.recurse(child)
-            
-            # Process closing tag
-            self.close_tag(tree.tag)
+        """Process the tree structure: words of Text nodes, opening and closing tags of Elements"""
+        for node, entering in walk(tree):
+            if isinstance(node, Text):
+                if entering:
+                    for word in node.text.split():
+                        self.word(word)
+            elif entering:
+                self.open_tag(node.tag, node.attributes)
+            else:
+                self.close_tag(node.tag)
 
     def open_tag(self, tag, attributes):
         """Handle opening HTML tags"""
@@ -0,0 +1,276 @@
+# Parallel layout: large block subtrees are laid out in worker processes, then stitched into the layout tree
+#
+# A block's width and x come from above, only its y depends on the blocks before it. So a subtree can be
+# laid out anywhere at y = 0, and moved into place afterwards. Workers get a snapshot of the subtree (DOM
+# records plus the few style values layout reads), and send back heights, measured words and lines.
+# Needs a font backend that works outside the main process (truetype, not Tk).
+from array import array
+from concurrent.futures import ProcessPoolExecutor
+from parser import Text, Element
+from layout_tree import BlockLayout, LineLayout, InlineContent, FONTS, layout_mode
+from font_metrics import get_backend, set_backend
+from font_registry import get_font
+from traversal import preorder, postorder
+from constants import HSTEP, PARALLEL_LAYOUT_MIN_NODES, PARALLEL_LAYOUT_CHUNKS
+
+
+def start_workers(workers):
+    """A process pool whose workers measure text like this process does"""
+    return ProcessPoolExecutor(workers, initializer=set_backend, initargs=(get_backend().name,))
+
+
+# snapshot of the subtrees sent to a worker, in the form of dom_cache.encode_tree()
+
+def snapshot(roots):
+    """(styles, records): pre-order records of the subtrees, (tag, attributes, child_count, style) for
+    Elements and (text, style) for Texts. Styles are indices into `styles`, which only holds the
+    (font_size, weight, slant) layout reads, once per distinct computed style."""
+    styles, style_ids = [], {}
+    records = []
+    for root in roots:
+        for node in preorder(root):
+            style_id = style_ids.get(id(node.style))
+            if style_id is None:
+                style_id = style_ids[id(node.style)] = len(styles)
+                styles.append((node.style.font_size, node.style.weight, node.style.slant))
+            if isinstance(node, Text):
+                records.append((node.text, style_id))
+            else:
+                records.append((node.tag, node.attributes, len(node.children), style_id))
+    return styles, records
+
+
+class LayoutStyle:
+    """What layout reads from a computed style"""
+    def __init__(self, font_size, weight, slant):
+        self.font_size = font_size
+        self.weight = weight
+        self.slant = slant
+
+
+def restore(snapshot):
+    """Rebuilds the subtrees of a snapshot, returns their roots"""
+    styles, records = snapshot
+    styles = [LayoutStyle(*style) for style in styles]
+    roots = []
+    stack = [] # [element, children still to be attached]
+    for record in records:
+        parent = stack[-1][0] if stack else None
+        if len(record) == 2:
+            text, style_id = record
+            node, child_count = Text(text, parent), 0
+        else:
+            tag, attributes, child_count, style_id = record
+            node = Element(tag, attributes, parent)
+        node.style = styles[style_id]
+
+        if parent is None:
+            roots.append(node)
+        else:
+            parent.children.append(node)
+            stack[-1][1] -= 1
+        if child_count:
+            stack.append([node, child_count])
+        while stack and stack[-1][1] == 0:
+            stack.pop()
+    return roots
+
+
+# worker side
+
+class SubtreeParent:
+    """Stands in for the block the subtrees are children of: its x and width, and y = 0"""
+    def __init__(self, x, width):
+        self.x = x
+        self.y = 0
+        self.width = width
+
+
+def inline_children(block):
+    return block.children if block.inline is None else () # lines are sent with their block
+
+
+def encode_lines(lines):
+    """The lines of a block as one set of arrays (pickling an array per line costs more than its words):
+    the words of all lines one after the other, and each line's word count, alignment and height"""
+    words, xs, widths, font_ids, supers = array("l"), array("l"), array("l"), array("l"), array("b")
+    for line in lines:
+        words.extend(line.words)
+        xs.extend(line.xs)
+        widths.extend(line.widths)
+        font_ids.extend(line.font_ids)
+        supers.extend(line.supers)
+    counts = array("l", [len(line.words) for line in lines])
+    return words, xs, widths, font_ids, supers, counts, [line.align for line in lines], [line.height for line in lines]
+
+
+def encode_layout(block):
+    """Pre-order (height, inline) records of the blocks of a laid out subtree. inline is None in block
+    mode, otherwise the block's InlineContent and lines as arrays, Text nodes as pre-order indices."""
+    node_index = {id(node): i for i, node in enumerate(preorder(block.node))}
+    records = []
+    for obj in preorder(block, inline_children):
+        content = obj.inline
+        if content is None:
+            records.append((obj.height, None))
+            continue
+        records.append((obj.height, (content.text, content.starts, content.ends, content.widths, content.font_ids,
+                                     content.node_ids, [node_index[id(node)] for node in content.nodes], content.tags,
+                                     encode_lines(obj.children))))
+    return records
+
+
+def layout_job(job):
+    """Lays out consecutive sibling subtrees from their snapshot. Returns the font keys behind this
+    process's font ids, and the records of each subtree."""
+    roots, x, width = restore(job[0]), job[1], job[2]
+    parent = SubtreeParent(x, width)
+    previous = None
+    results = []
+    for root in roots:
+        block = BlockLayout(root, parent, previous)
+        block.layout()
+        results.append(encode_layout(block))
+        previous = block
+    return list(FONTS.keys), results
+
+
+# main process side
+
+class LayoutJob:
+    """Subtrees sent to a worker together"""
+    def __init__(self, future):
+        self.future = future
+        self.result = None
+
+    def records(self, index):
+        """(font ids, records) of the index-th subtree, font ids mapping the worker's to this process's"""
+        if self.result is None:
+            keys, results = self.future.result() # waits for the worker
+            font_ids = [FONTS.id(get_font(size, weight, style)) for _, size, weight, style in keys]
+            self.result = (font_ids, results)
+        font_ids, results = self.result
+        return font_ids, results[index]
+
+
+class PreparedSubtree:
+    """A block whose subtree a worker lays out; BlockLayout.layout_position() installs it in its place"""
+    def __init__(self, job, index, x, width):
+        self.job = job
+        self.index = index
+        self.x = x
+        self.width = width
+
+    def install(self, block, stats):
+        """Builds the layout objects below `block` from the worker's records, at the block's y.
+        False if the block isn't where the worker assumed, it's then laid out as usual."""
+        if block.x != self.x or block.width != self.width:
+            return False
+        font_ids, records = self.job.records(self.index)
+        same_fonts = font_ids == list(range(len(font_ids)))
+
+        def fonts(ids):
+            return ids if same_fonts else array("l", [font_ids[i] for i in ids])
+
+        nodes = list(preorder(block.node))
+        for node in nodes:
+            node.layout_dirty = node.layout_child_dirty = False
+
+        records = iter(records)
+        for obj in preorder(block, inline_children): # blocks in the same order as encode_layout()
+            height, inline = next(records)
+            if obj is not block:
+                obj.x, obj.width = block.x, block.width
+                obj.y = obj.previous.y + obj.previous.height if obj.previous else obj.parent.y
+            obj.height = height
+            obj.reused = obj.estimated = obj.pending = False
+            stats["laid_out"] += 1
+
+            if inline is None:
+                obj.inline = None
+                obj.children = []
+                previous = None
+                for child in obj.node.children:
+                    previous = BlockLayout(child, obj, previous)
+                    obj.children.append(previous)
+                continue
+
+            text, starts, ends, widths, word_fonts, node_ids, text_nodes, tags, lines = inline
+            content = obj.inline = InlineContent()
+            content.text, content.words = text, None
+            content.starts, content.ends, content.widths = starts, ends, widths
+            content.font_ids, content.node_ids = fonts(word_fonts), node_ids
+            content.nodes = [nodes[i] for i in text_nodes]
+            content.tags = tags
+
+            words, xs, line_widths, line_fonts, supers, counts, aligns, heights = lines
+            line_fonts = fonts(line_fonts)
+            obj.children = []
+            y, start, previous = obj.y, 0, None
+            for count, align, line_height in zip(counts, aligns, heights):
+                end = start + count
+                line = LineLayout(obj.node, obj, previous)
+                line.words, line.xs, line.widths = words[start:end], xs[start:end], line_widths[start:end]
+                line.font_ids, line.supers = line_fonts[start:end], supers[start:end]
+                line.align = align
+                line.x, line.y, line.width, line.height = obj.x, y, obj.width, line_height
+                obj.children.append(line)
+                y, start, previous = y + line_height, end, line
+            stats["laid_out"] += len(counts)
+
+        block.reused = True # everything inside is in place already
+        return True
+
+
+def split_jobs(root, workers):
+    """Groups of consecutive sibling nodes to lay out in workers, in document order.
+
+    Block mode nodes too big for one job are split into their children; every group is about
+    1/(workers * PARALLEL_LAYOUT_CHUNKS) of the document, and groups smaller than
+    PARALLEL_LAYOUT_MIN_NODES are left to the main process."""
+    sizes = {}
+    for node in postorder(root):
+        sizes[id(node)] = 1 + sum([sizes[id(child)] for child in node.children])
+    target = max(sizes[id(root)] // (workers * PARALLEL_LAYOUT_CHUNKS), PARALLEL_LAYOUT_MIN_NODES)
+
+    jobs = []
+    stack = [("split", root)] if layout_mode(root) == "block" else []
+    while stack:
+        kind, item = stack.pop()
+        if kind == "job":
+            jobs.append(item)
+            continue
+
+        items, group, size = [], [], 0
+        for child in item.children:
+            if sizes[id(child)] > target and layout_mode(child) == "block":
+                if size >= PARALLEL_LAYOUT_MIN_NODES:
+                    items.append(("job", group))
+                items.append(("split", child))
+                group, size = [], 0
+                continue
+            group.append(child)
+            size += sizes[id(child)]
+            if size >= target:
+                items.append(("job", group))
+                group, size = [], 0
+        if size >= PARALLEL_LAYOUT_MIN_NODES:
+            items.append(("job", group))
+        stack.extend(reversed(items)) # the first one is popped first
+    return jobs
+
+
+def layout_parallel(document, executor, workers):
+    """The first layout() of a document, with its large subtrees laid out by `executor`'s worker processes
+    while this process lays out the rest. Later layouts are incremental and don't need workers."""
+    if document.children or get_backend().name == "tk":
+        return document.layout()
+
+    # every block is as wide as the document (see DocumentLayout.layout)
+    x, width = HSTEP, document.viewport_width - 2 * HSTEP
+    prepared = {}
+    for roots in split_jobs(document.node, workers):
+        job = LayoutJob(executor.submit(layout_job, (snapshot(roots), x, width)))
+        for i, root in enumerate(roots):
+            prepared[id(root)] = PreparedSubtree(job, i, x, width)
+    return document.layout(prepared=prepared)
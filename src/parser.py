@@ -1,12 +1,28 @@
+from traversal import preorder, with_depth
+
+
 class Text:
     def __init__(self, text, parent):
         self.text = text
         self.children = [] # always empty, just for consistency kept here
         self.parent = parent
 
+        # incremental restyle: style_dirty -> this node needs restyling, child_dirty -> some descendant does
+        self.style_dirty = True
+        self.child_dirty = False
+
+        # incremental relayout, same scheme: layout_dirty -> the block containing this node must be laid out again
+        self.layout_dirty = True
+        self.layout_child_dirty = False
+
     def __repr__(self):
         return repr(self.text)
 
+    def set_text(self, text):
+        """Changes the text and marks its block for relayout"""
+        self.text = text
+        mark_layout_dirty(self)
+
 
 class Element:
     def __init__(self, tag, attributes, parent):
@@ -14,11 +30,56 @@ class Element:
         self.attributes = attributes
         self.children = []
         self.parent = parent
+
+        self.style_dirty = True
+        self.child_dirty = False
+        self.layout_dirty = True
+        self.layout_child_dirty = False
         
 
     def __repr__(self):
         return "<" + self.tag + ">"
 
+    def set_attribute(self, name, value):
+        """Changes an attribute and marks what has to be restyled"""
+        self.attributes[name] = value
+        self.attribute_changed(name)
+
+    def remove_attribute(self, name):
+        if name in self.attributes:
+            del self.attributes[name]
+            self.attribute_changed(name)
+
+    def attribute_changed(self, name):
+        if name in ("id", "class"):
+            mark_subtree_dirty(self) # descendant selectors of the children may depend on it
+        else:
+            mark_style_dirty(self)
+        mark_layout_dirty(self) # e.g. class="title" changes how an h1 is laid out, whatever its style
+
+
+def mark_style_dirty(node):
+    """Flags `node` for restyling, and its ancestors as having a dirty descendant"""
+    node.style_dirty = True
+    node = node.parent
+    while node and not node.child_dirty:
+        node.child_dirty = True
+        node = node.parent
+
+
+def mark_layout_dirty(node):
+    """Flags `node` for relayout, and its ancestors as having a descendant to lay out again"""
+    node.layout_dirty = True
+    node = node.parent
+    while node and not node.layout_child_dirty:
+        node.layout_child_dirty = True
+        node = node.parent
+
+
+def mark_subtree_dirty(node):
+    for descendant in preorder(node):
+        mark_style_dirty(descendant)
+
 
 class HTMLParser:
     def __init__(self, body):
@@ -204,7 +265,7 @@ class HTMLParser:
     
     def implicit_tags(self, tag):
         while True:
-            open_tags = [node.tag for node in self.unfinished]
+            open_tags = [node.tag for node in self.unfinished[:3]] # only the outermost ones matter, keeps deep documents linear
             
             if open_tags == [] and tag != "html":
                 self.add_tag("html")
@@ -220,7 +281,5 @@ class HTMLParser:
     
 
 def print_tree(node, indent=0):
-    print(" " * indent, node)
-
-    for child in node.children:
-        print_tree(child, indent + 2)
+    for descendant, depth in with_depth(node):
+        print(" " * (indent + 2 * depth), descendant)
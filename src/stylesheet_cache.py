@@ -0,0 +1,114 @@
+# Parsed style sheet cache, and the precompiled user-agent style sheet
+import marshal
+import os
+from collections import OrderedDict
+from css_parser import CSSParser, TagSelector, DescendantSelector, RuleMap
+from dom_cache import content_hash
+from utils import cascade_priority
+
+USER_AGENT_CSS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "user_agent.css")
+COMPILED_VERSION = 1
+
+
+# compiled form of rules: plain tuples/dicts that marshal can load without running the CSS parser
+
+def encode_selector(selector):
+    if isinstance(selector, DescendantSelector):
+        return (encode_selector(selector.ancestor), encode_selector(selector.descendant))
+    return selector.tag
+
+
+def decode_selector(encoded):
+    if isinstance(encoded, tuple):
+        return DescendantSelector(decode_selector(encoded[0]), decode_selector(encoded[1]))
+    return TagSelector(encoded)
+
+
+def compile_rules(rules):
+    return [(encode_selector(selector), body) for selector, body in rules]
+
+
+def load_compiled(compiled):
+    return [(decode_selector(selector), body) for selector, body in compiled]
+
+
+class StylesheetCache:
+    """Parsed rules per (URL, content hash), and bucketed RuleMaps per combination of style sheets.
+
+    A style sheet shared by a whole site is parsed once, and navigating between pages that link the
+    same sheets reuses the same RuleMap."""
+    def __init__(self, capacity, user_agent_css=USER_AGENT_CSS):
+        self.capacity = capacity
+        self.user_agent_css = user_agent_css
+        self.user_agent_sheet = None # (key, rules), loaded on first use
+        self.sheets = OrderedDict() # (url, digest) -> rules, least recently used first
+        self.rule_maps = OrderedDict() # tuple of sheet keys -> RuleMap
+        self.stats = {"hits": 0, "misses": 0, "rule_map_hits": 0, "rule_map_misses": 0}
+
+    def user_agent(self):
+        """(key, rules) of the user-agent style sheet, from its compiled form when that's up to date"""
+        if self.user_agent_sheet is None:
+            with open(self.user_agent_css) as f:
+                source = f.read()
+            digest = content_hash(source)
+            rules = self.read_compiled(digest)
+            if rules is None:
+                rules = CSSParser(source).parse()
+                self.write_compiled(digest, rules)
+            self.user_agent_sheet = (("user-agent", digest), rules)
+        return self.user_agent_sheet
+
+    def parse(self, url, body):
+        """(key, rules) of a linked style sheet, parsing `body` only if it wasn't seen at this URL before"""
+        key = (str(url), content_hash(body))
+        if key in self.sheets:
+            self.stats["hits"] += 1
+            self.sheets.move_to_end(key)
+        else:
+            self.stats["misses"] += 1
+            self.sheets[key] = CSSParser(body).parse()
+            if len(self.sheets) > self.capacity:
+                self.sheets.popitem(last=False)
+        return key, self.sheets[key]
+
+    def rule_map(self, sheets):
+        """The RuleMap for a list of (key, rules), in document order"""
+        key = tuple(sheet_key for sheet_key, _ in sheets)
+        if key in self.rule_maps:
+            self.stats["rule_map_hits"] += 1
+            self.rule_maps.move_to_end(key)
+            return self.rule_maps[key]
+
+        self.stats["rule_map_misses"] += 1
+        rules = []
+        for _, sheet_rules in sheets:
+            rules.extend(sheet_rules)
+        rule_map = RuleMap(sorted(rules, key=cascade_priority)) # cascading, file-order acts as tie-breaker
+        self.rule_maps[key] = rule_map
+        if len(self.rule_maps) > self.capacity:
+            self.rule_maps.popitem(last=False)
+        return rule_map
+
+    # compiled user-agent style sheet
+
+    def compiled_path(self):
+        return self.user_agent_css + ".compiled"
+
+    def read_compiled(self, digest):
+        try:
+            with open(self.compiled_path(), "rb") as f:
+                version, source_digest, compiled = marshal.load(f)
+        except (OSError, ValueError, EOFError, TypeError):
+            return None
+        if version != COMPILED_VERSION or source_digest != digest:
+            return None # user_agent.css was edited since
+        return load_compiled(compiled)
+
+    def write_compiled(self, digest, rules):
+        try:
+            path = self.compiled_path()
+            with open(path + ".tmp", "wb") as f:
+                marshal.dump((COMPILED_VERSION, digest, compile_rules(rules)), f)
+            os.replace(path + ".tmp", path)
+        except OSError:
+            pass # read-only install, just parse it every time
@@ -0,0 +1,63 @@
+# Iterative tree walks shared by every pass (style, layout, paint, hit-testing)
+# Explicit stacks instead of recursion: depth is only limited by memory, not by Python's recursion limit.
+# Works on both HTML and layout trees (anything with a `children` list).
+
+
+def walk(root, children=None):
+    """Yields (node, True) when entering a node and (node, False) when leaving it, in document order.
+
+    `children(node)` picks the children to descend into (all of them by default). It is called
+    only after the consumer has handled (node, True), so it can look at what that step computed."""
+    stack = [(root, True)]
+    while stack:
+        node, entering = stack.pop()
+        yield node, entering
+        if entering:
+            stack.append((node, False))
+            kids = node.children if children is None else children(node)
+            for i in range(len(kids) - 1, -1, -1): # reversed, so the first child is popped first
+                stack.append((kids[i], True))
+
+
+def preorder(root, children=None):
+    """Yields every node before its descendants; `children` filters like in walk()"""
+    stack = [root]
+    while stack:
+        node = stack.pop()
+        yield node
+        kids = node.children if children is None else children(node)
+        for i in range(len(kids) - 1, -1, -1):
+            stack.append(kids[i])
+
+
+def postorder(root, children=None):
+    """Yields every node after its descendants"""
+    for node, entering in walk(root, children):
+        if not entering:
+            yield node
+
+
+def with_depth(root):
+    """Yields (node, depth) in pre-order, the root being at depth 0"""
+    stack = [(root, 0)]
+    while stack:
+        node, depth = stack.pop()
+        yield node, depth
+        for i in range(len(node.children) - 1, -1, -1):
+            stack.append((node.children[i], depth + 1))
+
+
+def select(root, predicate, children=None):
+    """Yields the nodes matching `predicate`, in pre-order"""
+    for node in preorder(root, children):
+        if predicate(node):
+            yield node
+
+
+def find_last(root, predicate, children=None):
+    """The last node (in pre-order) matching `predicate`, or None, e.g. the topmost painted object under a point"""
+    found = None
+    for node in preorder(root, children):
+        if predicate(node):
+            found = node
+    return found
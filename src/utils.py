@@ -1,4 +1,6 @@
 # Utility functions
+from traversal import preorder
+
 def show(body):
     length = len(body)
     i = 0
@@ -34,12 +36,10 @@ def load(url):
 
 
 def tree_to_list(tree, list):
-    """Turns a tree of nodes into a list of nodes. Works on both HTML and Layout Trees."""
-    list.append(tree)
-    
-    for child in tree.children:
-        tree_to_list(child, list)
+    """Turns a tree of nodes into a list of nodes. Works on both HTML and Layout Trees.
 
+    Passes that only iterate should use traversal.preorder() directly instead of building the list."""
+    list.extend(preorder(tree))
     return list
 
 
@@ -51,10 +51,11 @@ def cascade_priority(rule):
 
 # Helper function to parse font-sizes properly
 
-def parse_font_size(font_size_str):
+def parse_font_size(font_size_str, parent_px=16):
         """
-        Parse CSS font-size value and return size in pixels.
+        Parse CSS font-size value and return size in pixels (a float).
         Handles px units, keywords, and other common cases.
+        em and % are relative to the parent's size in pixels.
         """
         font_size_str = font_size_str.strip().lower()
         
@@ -70,41 +71,66 @@ def parse_font_size(font_size_str):
         }
         
         if font_size_str in keyword_sizes:
-            return keyword_sizes[font_size_str]
+            return float(keyword_sizes[font_size_str])
         
         # Handle px values
         if font_size_str.endswith('px'):
             try:
-                return int(float(font_size_str[:-2]))
+                return float(font_size_str[:-2])
             except ValueError:
-                return 16  # fallback to default
+                return 16.0  # fallback to default
         
         # Handle pt values (1pt = 4/3 px approximately)
         if font_size_str.endswith('pt'):
             try:
                 pt_value = float(font_size_str[:-2])
-                return int(pt_value * 4 / 3)
+                return pt_value * 4 / 3
             except ValueError:
-                return 16
+                return 16.0
         
-        # Handle em values (relative to parent, assume 16px base for now)
+        # Handle em values (relative to parent)
         if font_size_str.endswith('em'):
             try:
                 em_value = float(font_size_str[:-2])
-                return int(em_value * 16)  # assuming 16px base
+                return em_value * parent_px
             except ValueError:
-                return 16
+                return float(parent_px)
         
-        # Handle percentage values
+        # Handle percentage values (relative to parent)
         if font_size_str.endswith('%'):
             try:
                 percent_value = float(font_size_str[:-1])
-                return int((percent_value / 100) * 16)  # assuming 16px base
+                return (percent_value / 100) * parent_px
             except ValueError:
-                return 16
+                return float(parent_px)
         
         # Try to parse as a number (assume px)
         try:
-            return int(float(font_size_str))
+            return float(font_size_str)
         except ValueError:
-            return 16  # fallback to default browser font size
\ No newline at end of file
+            return 16.0  # fallback to default browser font size
+
+
+def parse_font_weight(weight):
+    """Normalizes a CSS font-weight to the two weights Tk knows: "normal" or "bold" """
+    weight = weight.strip().lower()
+    if weight in ("bold", "bolder"):
+        return "bold"
+    if weight.isdigit():
+        return "bold" if int(weight) >= 600 else "normal"
+    return "normal"
+
+
+def parse_font_style(style):
+    """Normalizes a CSS font-style to a Tk slant: "roman" or "italic" """
+    return "italic" if style.strip().lower() in ("italic", "oblique") else "roman"
+
+
+def parse_color(color):
+    """Normalizes a CSS color for Tk: lowercase, #rgb expanded to #rrggbb, None for transparent"""
+    color = color.strip().lower()
+    if color == "transparent":
+        return None
+    if len(color) == 4 and color.startswith("#"):
+        return "#" + "".join(c * 2 for c in color[1:])
+    return color